@@ -1,8 +1,34 @@
 #!/bin/python3
 
+import os
+import sys
+
+# RPG_HEADLESS=1 (or a --headless replay) runs without a window, e.g. for automated runs of the Simulation
+HEADLESS = bool(os.environ.get("RPG_HEADLESS")) or "--headless" in sys.argv
+if HEADLESS:
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
 from dia_graphics import *
+from rpg_data import decode, read_json, load_level_data, validate_translations, DataFormatError, encode_savestate, read_savestate, write_atomic
+from array import array
+from collections import OrderedDict
+from itertools import islice
+import argparse
+import ast
+import json
+import logging
+import struct
+import threading
 import time
 import math
+import zlib
+
+# NumPy is optional, without it the enemies are updated one by one
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 true = True
 false = False
@@ -12,6 +38,17 @@ HEIGHT = 640
 
 FPS = 30
 
+# the level logic runs at a fixed TICK_RATE, rendering runs as fast as MAX_FPS allows
+TICK_RATE = 30
+MAX_FPS = 144
+MAX_TICKS_PER_FRAME = 5
+
+# screens without animations sleep until an event arrives, waking at least every IDLE_TIMEOUT ms
+IDLE_TIMEOUT = 1000
+
+SAVESTATE_FILE = "savestate.sav"
+LEGACY_SAVESTATE_FILE = "savestate.json"
+
 # Setup Colors
 COLORS = Enum()
 COLORS.set(black = Color(0, 0, 0))
@@ -29,59 +66,310 @@ COLORS.set(secondary = Color(200, 0, 0, 127))
 COLORS.set(consumable = Color(0, 0, 200, 127))
 COLORS.set(red = Color(200, 0, 0))
 COLORS.set(aqua = Color(100, 200, 200))
+COLORS.set(shadow = Color(0, 0, 0, 127))
 
 # Setup Message Translations
-with open(get__path("rpg/data/translations/en.json"), "r") as file:
-    MSG = eval(file.read())
+MSG = validate_translations(read_json(get__path("rpg/data/translations/en.json")), "en")
 
 # Initialize dia_graphics
 init__logger("__LOGS__/rpg.log")
+
+# Setup the loggers of the game (rpg.save, rpg.profiler, ...): INFO and up, into the game's log file
+# unless the logger of dia_graphics already handles the records through the root logger
+def init_game_logging(filename: str = "__LOGS__/rpg.log"):
+    logger = logging.getLogger("rpg")
+    logger.setLevel(logging.INFO)
+    if not logging.getLogger().handlers and not logger.handlers:
+        os.makedirs(os.path.dirname(filename), exist_ok = True)
+        handler = logging.FileHandler(filename)
+        handler.setFormatter(logging.Formatter("%(asctime)s %(name)s %(levelname)s: %(message)s"))
+        logger.addHandler(handler)
+
+init_game_logging()
 init__surface((WIDTH, HEIGHT), (WIDTH, HEIGHT), 8, 1.0, flags=false, title=MSG["title"], factor_default=HEIGHT, def_plugin="rpg", loading_sign_color=COLORS.light_brown, loading_bar_color=COLORS.dark_green, loading_bar_progress_color=COLORS.grey_green)
 init__fonts(COLORS, MSG, name="rpg", scale_factor = 0.5)
 
 
+# Get a new value for the version counters, unique over all counters
+VERSION_COUNTER = [0]
+def next_version():
+    VERSION_COUNTER[0] += 1
+    return VERSION_COUNTER[0]
+
+
+# Get a hashable key for a Color
+def color_key(color):
+    if color is None:
+        return None
+    try:
+        return tuple(color)
+    except TypeError:
+        return repr(getattr(color, "__dict__", color))
+
+
+# Class for a least recently used cache of rendered Text surfaces, bounded by their memory
+class TextCache:
+    def __init__(self, max_bytes: int = 8 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # get the (shared, not to be modified) Text surface, rendering it on a miss
+    def get(self, text: str, color: Color, background: Color = None, font_size: float = 1, font: str = None):
+        key = (text, color_key(color), color_key(background), font_size, font)
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key][0]
+        self.misses += 1
+        if font is None:
+            surface = Text(text, color, background, font_size)
+        else:
+            surface = Text(text, color, background, font_size, font=font)
+        size = surface.size[0] * surface.size[1] * 4
+        self.entries[key] = (surface, size)
+        self.bytes += size
+        while self.bytes > self.max_bytes and len(self.entries) > 1:
+            self.bytes -= self.entries.popitem(last=False)[1][1]
+            self.evictions += 1
+        return surface
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
+    def get_stats(self):
+        return {"entries": len(self.entries), "bytes": self.bytes, "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+TEXT_CACHE = TextCache()
+
+# Class for the AssetManager, sharing decoded images by (path, size) and evicting unused ones
+class AssetManager:
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.refs = {}.copy()
+        self.owners = {}.copy()
+        self.scope = None
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.RLock()
+
+    # get the (shared, not to be modified) image, referenced by owner (default: the current scope)
+    # unless keep is False, then it may be evicted as soon as it is least recently used
+    def get(self, path: str, size: tuple = None, owner = None, keep: bool = True):
+        key = (path, tuple(size) if size else None)
+        with self.lock:
+            if owner is None and keep: owner = self.scope
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                self.acquire(key, owner)
+                return self.entries[key][0]
+            self.misses += 1
+        
+        # decode outside of the lock, so a preloading thread doesn't block the game
+        surface = Image(path, size) if size else Image(path)
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = (surface, surface.size[0] * surface.size[1] * 4)
+                self.bytes += self.entries[key][1]
+            self.acquire(key, owner)
+            self.evict()
+            return self.entries[key][0]
+
+    def acquire(self, key, owner):
+        if owner is None:
+            return
+        with self.lock:
+            self.refs.setdefault(key, set()).add(owner)
+            self.owners.setdefault(owner, set()).add(key)
+
+    # drop all references of an owner, e.g. a finished level
+    def release(self, owner):
+        with self.lock:
+            for key in self.owners.pop(owner, set()):
+                self.refs[key].discard(owner)
+                if not self.refs[key]:
+                    del self.refs[key]
+            self.evict()
+
+    # set the owner of images loaded from now on, returns the previous one
+    def set_scope(self, owner):
+        previous = self.scope
+        self.scope = owner
+        return previous
+
+    # evict the least recently used unreferenced images until the memory budget is kept
+    def evict(self):
+        with self.lock:
+            if self.bytes <= self.max_bytes:
+                return
+            for key in list(self.entries):
+                if self.bytes <= self.max_bytes:
+                    break
+                if key not in self.refs:
+                    self.bytes -= self.entries.pop(key)[1]
+                    self.evictions += 1
+
+    def get_resident_bytes(self):
+        return self.bytes
+
+    # drop an image from the cache, also if it is still referenced (e.g. a source that was cut into tiles)
+    def drop(self, path: str, size: tuple = None):
+        key = (path, tuple(size) if size else None)
+        with self.lock:
+            if key in self.entries:
+                self.bytes -= self.entries.pop(key)[1]
+            for owner in self.refs.pop(key, set()):
+                self.owners[owner].discard(key)
+
+    def is_resident(self, path: str, size: tuple = None):
+        with self.lock:
+            return (path, tuple(size) if size else None) in self.entries
+
+    def get_stats(self):
+        return {"entries": len(self.entries), "bytes": self.bytes, "referenced": len(self.refs), "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+ASSETS = AssetManager()
+
+
+# Load the glyph widths of a bitmap font from its metrics file
+def load_font_metrics(path: str):
+    with open(get__path(path), "r") as file:
+        metrics = ast.literal_eval(file.read())
+    width = metrics["size"][0]
+    return {k: width for k in metrics if k != "size"}
+
+FONT_METRICS = load_font_metrics("rpg/data/fonts/rpg.font")
+
+# Get the width of a text in the rpg font
+def text_width(text: str, font_size: float = 1):
+    return sum(FONT_METRICS.get(c, FONT_METRICS["default"]) for c in text) * font_size
+
+# Get a rendered Text from the shared TEXT_CACHE
+def cached_text(text: str, color: Color, background: Color = None, font_size: float = 1, font: str = None):
+    return TEXT_CACHE.get(text, color, background, font_size, font)
+
+
+
+# Get the memory report of a level: {type: {"count": n, "bytes": b}} for the objects it references,
+# containers and numbers counted with the object holding them, shared assets (surfaces) left out
+def get_memory_report(root):
+    report = {}.copy()
+    seen = set()
+    stack = [(root, type(root).__name__)]
+    while stack:
+        o, owner = stack.pop()
+        if id(o) in seen or isinstance(o, (Surface, ScreenObject, Enum, type, type(len), type(get_memory_report))):
+            continue
+        seen.add(id(o))
+        size = sys.getsizeof(o)
+        children = ()
+        if isinstance(o, dict):
+            children = list(o.keys()) + list(o.values())
+        elif isinstance(o, (list, tuple, set, frozenset)):
+            children = o
+        elif not isinstance(o, (str, bytes, bytearray, int, float, bool, array)) and (np is None or not isinstance(o, np.ndarray)) and o is not None:
+            owner = type(o).__name__
+            entry = report.setdefault(owner, {"count": 0, "bytes": 0})
+            entry["count"] += len(o) if isinstance(o, HitboxArray) else 1
+            children = [getattr(o, k) for c in type(o).__mro__ for k in getattr(c, "__slots__", ()) if hasattr(o, k)]
+            if hasattr(o, "__dict__"):
+                size += sys.getsizeof(o.__dict__)
+                children += list(o.__dict__.values())
+        report.setdefault(owner, {"count": 0, "bytes": 0})["bytes"] += size
+        stack.extend((c, owner) for c in children)
+    return report
+
 
 # Class for a loaded Level
 class Level:
-    def __init__(self, lvl_id: str, init_dict: dict):
+    def __init__(self, lvl_id: str, init_dict: dict, file_dict: dict = None):
         self.lvl_id = lvl_id
         self.init_dict = init_dict
         
-        with open(get__path(f"rpg/data/levels/{self.lvl_id}.json"), "r") as file:
-            self.file_dict = eval(file.read())
+        # a given file_dict (e.g. a generated level) replaces the level file
+        # it is unpacked here and not kept, the level holds only its objects
+        if file_dict is None:
+            file_dict = load_level_file(self.lvl_id)
         
-        self.obstacle_hitboxes = [].copy()
-        if "obstacle_hitboxes" in self.file_dict:
-            for o in self.file_dict["obstacle_hitboxes"]:
-                self.obstacle_hitboxes.append(ObstacleHitbox(o))
+        # the static hitboxes are packed into arrays, there can be tens of thousands of them
+        self.obstacle_hitboxes = HitboxArray(file_dict.get("obstacle_hitboxes", [].copy()))
             
         self.interactable_objects = [].copy()
-        if "interactable_objects" in self.file_dict:
-            for i in self.file_dict["interactable_objects"]:
+        if "interactable_objects" in file_dict:
+            for i in file_dict["interactable_objects"]:
                 self.interactable_objects.append(InteractableObject(i))
         
-        self.movement_speed = self.file_dict["movement_speed"]
-        self.starting_pos = self.file_dict["starting_pos"]
-        self.start_dialog = MSG[self.file_dict["start_dialog"]]
-        self.target = self.file_dict["target"]
-        self.next_level = self.file_dict["next_level"]
-        self.enemies = [].copy()
-        if "enemies" in self.file_dict:
-            for i in self.file_dict["enemies"]:
-                self.enemies.append(Enemy(i))
+        # index the level geometry, so collision checks only test nearby rectangles
+        self.obstacle_grid = HitboxGrid(self.obstacle_hitboxes)
+        self.interactable_grid = SpatialGrid()
+        for o in self.interactable_objects:
+            self.interactable_grid.insert(o)
+        
+        self.movement_speed = file_dict["movement_speed"]
+        self.starting_pos = file_dict["starting_pos"]
+        self.start_dialog = MSG[file_dict["start_dialog"]]
+        self.target = file_dict["target"]
+        self.next_level = file_dict["next_level"]
+        self.background_manifest = file_dict.get("background")
+        self.enemy_batch = EnemyBatch(file_dict.get("enemies", [].copy()))
+        self.enemies = self.enemy_batch.enemies.copy()
+        self.enemy_hash = self.enemy_batch.hash
+        self.enemy_version = next_version()
+        # load the images of dropped loot with the level, not on the tick an enemy dies
+        if any(e.drops for e in self.enemies):
+            ASSETS.get(LOOT_IMAGE)
+            for item in {i.type for e in self.enemies for i in e.drops}:
+                ASSETS.get("items/" + item + ".png", (96, 96))
         self.update_surface()
+        
+        # rasterize the obstacles once, pursuing enemies follow a flow field around them
+        self.nav_grid = NavGrid(self.get_size(), self.obstacle_hitboxes)
+        
+        # rasterize the enemy trigger zones once, so triggers are looked up by the player's cell
+        self.trigger_index = TriggerIndex(self.get_size())
+        for e in self.enemies:
+            self.trigger_index.insert(e, e.trigger)
     
     def update_surface(self):
-        self.surface = Image(f"levels/{self.lvl_id}-background.png")
+        self.background = TiledBackground(self.lvl_id, self.background_manifest)
     
     def get_size(self):
-        return self.surface.size
+        return self.background.size
 
     def get_background(self):
-        return self.surface
+        return self.background
+    
+    def add_interactable_object(self, o):
+        self.interactable_objects.append(o)
+        self.interactable_grid.insert(o)
     
     def delete_interactable_object(self, i):
-        self.interactable_objects.pop(i)
+        self.interactable_grid.remove(self.interactable_objects.pop(i))
+    
+    # mark the enemy HP display as changed (damage, trigger, death)
+    def touch_enemies(self):
+        self.enemy_version = next_version()
+    
+    def remove_enemy(self, e):
+        self.enemies.remove(e)
+        self.enemy_batch.remove(e)
+        self.touch_enemies()
+    
+    def replace_interactable_object(self, i, new):
+        self.interactable_grid.remove(self.interactable_objects[i])
+        self.interactable_objects[i] = new
+        self.interactable_grid.insert(new)
+    
+    def get_memory_report(self):
+        return get_memory_report(self)
 
     def __repr__(self):
         return f"Level({self.lvl_id}, {self.init_dict})"
@@ -90,14 +378,569 @@ class Level:
         return self.__repr__()
 
 
-# Class for an ObstacleHitbox in a level
-class ObstacleHitbox(Position):
+# Convert the pixels of an opaque surface (e.g. a background tile) to the display format once,
+# so blitting it doesn't convert them again every frame; a no-op without a display
+# or if the dia_graphics Surface doesn't keep its pygame surface in .surface
+def convert_to_display(surface):
+    pixels = getattr(surface, "surface", None)
+    if pg.display.get_surface() is not None and isinstance(pixels, pg.Surface):
+        surface.surface = pixels.convert()
+    return surface
+
+
+# Class for a TiledBackground of a level, drawing only the tiles in the viewport
+# The tiles are either split offline into levels/<id>-background/<x>-<y>.png (see rpg_data.py),
+# announced by a "background": {"size": [w, h], "tile_size": n} entry in the level file,
+# or cut once from the single levels/<id>-background.png, which isn't kept afterwards;
+# the cut tiles are then the whole background, so only split levels keep just the tiles around the camera in memory
+class TiledBackground:
+    def __init__(self, lvl_id: str, manifest: dict = None, tile_size: int = 256, keep_margin: int = 1, scratch_count: int = 16):
+        self.lvl_id = lvl_id
+        self.keep_margin = keep_margin
+        self.tiles = {}.copy()
+        self.scratch = OrderedDict()
+        self.scratch_count = scratch_count
+        if manifest:
+            self.split = True
+            self.size = tuple(manifest["size"])
+            self.tile_size = manifest["tile_size"]
+            self.columns = -(-self.size[0] // self.tile_size)
+            self.rows = -(-self.size[1] // self.tile_size)
+        else:
+            # the cut tiles hold the only copy of the background, a tile can't be loaded again on its own
+            self.split = False
+            path = f"levels/{self.lvl_id}-background.png"
+            source = ASSETS.get(path, keep=False)
+            self.size = source.size
+            self.tile_size = tile_size
+            self.columns = -(-self.size[0] // self.tile_size)
+            self.rows = -(-self.size[1] // self.tile_size)
+            for x in range(self.columns):
+                for y in range(self.rows):
+                    size = (min(self.tile_size, self.size[0] - x * self.tile_size), min(self.tile_size, self.size[1] - y * self.tile_size))
+                    tile = Surface(size, COLORS.black)
+                    tile.blit(source, (-x * self.tile_size, -y * self.tile_size))
+                    self.tiles[(x, y)] = convert_to_display(tile)
+            ASSETS.drop(path)
+
+    def get_tile(self, tile: tuple):
+        if tile not in self.tiles:
+            self.tiles[tile] = convert_to_display(ASSETS.get(f"levels/{self.lvl_id}-background/{tile[0]}-{tile[1]}.png", keep=False))
+        return self.tiles[tile]
+
+    # get the range of tiles intersecting a screen rectangle
+    def get_tile_range(self, background_pos: tuple, rect: tuple):
+        x0 = max(0, int(rect[0] - background_pos[0]) // self.tile_size)
+        y0 = max(0, int(rect[1] - background_pos[1]) // self.tile_size)
+        x1 = min(self.columns - 1, int(rect[0] + rect[2] - 1 - background_pos[0]) // self.tile_size)
+        y1 = min(self.rows - 1, int(rect[1] + rect[3] - 1 - background_pos[1]) // self.tile_size)
+        return x0, y0, x1, y1
+
+    # draw the tiles in the viewport and drop the loaded ones far away from it
+    def draw(self, background_pos: tuple):
+        x0, y0, x1, y1 = self.get_tile_range(background_pos, (0, 0, WIDTH, HEIGHT))
+        for x in range(x0, x1 + 1):
+            for y in range(y0, y1 + 1):
+                draw(ScreenObject(self.get_tile((x, y))).set((background_pos[0] + x * self.tile_size, background_pos[1] + y * self.tile_size), 1))
+        if self.split:
+            m = self.keep_margin
+            for tile in [t for t in self.tiles if not (x0 - m <= t[0] <= x1 + m and y0 - m <= t[1] <= y1 + m)]:
+                del self.tiles[tile]
+
+    # get a surface to compose a region on, reused for regions of the same size (a moving sprite's region keeps its size)
+    def get_scratch(self, size: tuple, covered: bool):
+        # only a region the (opaque) tiles cover completely can be drawn over the previous content
+        if not covered:
+            return Surface(size, COLORS.black)
+        if size in self.scratch:
+            self.scratch.move_to_end(size)
+            return self.scratch[size]
+        surface = convert_to_display(Surface(size, COLORS.black))
+        self.scratch[size] = surface
+        if len(self.scratch) > self.scratch_count:
+            self.scratch.popitem(last=False)
+        return surface
+
+    # draw the background inside a screen rectangle only
+    def draw_region(self, background_pos: tuple, rect: tuple):
+        covered = (rect[0] >= background_pos[0] and rect[1] >= background_pos[1]
+            and rect[0] + rect[2] <= background_pos[0] + self.size[0] and rect[1] + rect[3] <= background_pos[1] + self.size[1])
+        region = self.get_scratch(tuple(rect[2:]), covered)
+        x0, y0, x1, y1 = self.get_tile_range(background_pos, rect)
+        for x in range(x0, x1 + 1):
+            for y in range(y0, y1 + 1):
+                region.blit(self.get_tile((x, y)), (background_pos[0] + x * self.tile_size - rect[0], background_pos[1] + y * self.tile_size - rect[1]))
+        draw(ScreenObject(region).set(rect[:2], 1))
+
+
+# Class for a uniform grid to look up level geometry near a position
+class SpatialGrid:
+    def __init__(self, cell_size: int = 128):
+        self.cell_size = cell_size
+        self.cells = {}.copy()
+        self.object_cells = {}.copy()
+
+    def get_cells(self, pos, size):
+        x0 = int(pos[0]) // self.cell_size
+        y0 = int(pos[1]) // self.cell_size
+        x1 = int(pos[0] + size[0]) // self.cell_size
+        y1 = int(pos[1] + size[1]) // self.cell_size
+        return [(x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)]
+
+    def insert(self, o):
+        cells = self.get_cells(o.pos, o.size)
+        for c in cells:
+            if c in self.cells:
+                self.cells[c].append(o)
+            else:
+                self.cells[c] = [o]
+        self.object_cells[id(o)] = cells
+
+    def remove(self, o):
+        for c in self.object_cells.pop(id(o), [].copy()):
+            self.cells[c] = [i for i in self.cells[c] if i is not o]
+            if not self.cells[c]:
+                del self.cells[c]
+
+    def query(self, pos, size):
+        found = {}.copy()
+        for c in self.get_cells(pos, size):
+            if c in self.cells:
+                for o in self.cells[c]:
+                    found[id(o)] = o
+        return found.values()
+
+    def __len__(self):
+        return len(self.object_cells)
+
+
+# Class for a uniform grid of the static hitboxes of a HitboxArray, its cells holding packed arrays of hitbox indices
+class HitboxGrid(SpatialGrid):
+    def __init__(self, hitboxes, cell_size: int = 128):
+        super().__init__(cell_size)
+        self.hitboxes = hitboxes
+        cells = {}.copy()
+        for i in range(len(hitboxes)):
+            x, y, w, h = hitboxes.get_rect(i)
+            for c in self.get_cells((x, y), (w, h)):
+                cells.setdefault(c, [].copy()).append(i)
+        self.cells = {c: array("i", l) for c, l in cells.items()}
+
+    def query(self, pos, size):
+        found = {}.copy()
+        for c in self.get_cells(pos, size):
+            if c in self.cells:
+                found.update(dict.fromkeys(self.cells[c]))
+        return [self.hitboxes[i] for i in found]
+
+    # check if any hitbox overlaps a rectangle, without creating views (the player's movement)
+    def collides(self, pos, size):
+        overlaps = self.hitboxes.overlaps
+        for c in self.get_cells(pos, size):
+            if c in self.cells:
+                for i in self.cells[c]:
+                    if overlaps(i, pos, size):
+                        return True
+        return False
+
+    def __len__(self):
+        return len(self.hitboxes)
+
+
+# Directions the player can face, as unit vectors in level coordinates
+FACING_DIRECTIONS = {"front": (0, 1), "back": (0, -1), "right": (1, 0), "left": (-1, 0)}
+
+# Class for a spatial hash of moving entities (enemies), re-bucketed only when one crosses a cell border
+# Entities are indexed by their surface rectangle and matched by their center
+class EntityHash(SpatialGrid):
+    def get_range(self, o):
+        return (int(o.pos[0]) // self.cell_size, int(o.pos[1]) // self.cell_size,
+            int(o.pos[0] + o.surface.size[0]) // self.cell_size, int(o.pos[1] + o.surface.size[1]) // self.cell_size)
+    
+    def insert(self, o):
+        r = self.get_range(o)
+        for x in range(r[0], r[2] + 1):
+            for y in range(r[1], r[3] + 1):
+                self.cells.setdefault((x, y), {}.copy())[id(o)] = o
+        self.object_cells[id(o)] = r
+    
+    def remove(self, o):
+        r = self.object_cells.pop(id(o), None)
+        if r is None:
+            return
+        for x in range(r[0], r[2] + 1):
+            for y in range(r[1], r[3] + 1):
+                del self.cells[(x, y)][id(o)]
+                if not self.cells[(x, y)]:
+                    del self.cells[(x, y)]
+    
+    # update the cells of entities after they moved
+    def move(self, entities):
+        for o in entities:
+            if id(o) in self.object_cells and self.get_range(o) != self.object_cells[id(o)]:
+                self.remove(o)
+                self.insert(o)
+    
+    def query(self, pos, size):
+        found = {}.copy()
+        for c in self.get_cells(pos, size):
+            if c in self.cells:
+                found.update(self.cells[c])
+        return found.values()
+    
+    def get_center(self, o):
+        return (o.pos[0] + o.surface.size[0] // 2, o.pos[1] + o.surface.size[1] // 2)
+    
+    # get the entities overlapping a rectangle (x, y, w, h)
+    def query_rect(self, rect: tuple):
+        return [o for o in self.query(rect[:2], rect[2:])
+            if o.pos[0] < rect[0] + rect[2] and rect[0] < o.pos[0] + o.surface.size[0]
+            and o.pos[1] < rect[1] + rect[3] and rect[1] < o.pos[1] + o.surface.size[1]]
+    
+    # get the entities whose center is within radius of a position
+    def query_radius(self, center: tuple, radius: float):
+        found = [].copy()
+        for o in self.query((center[0] - radius, center[1] - radius), (radius * 2, radius * 2)):
+            c = self.get_center(o)
+            if math.hypot(c[0] - center[0], c[1] - center[1]) <= radius:
+                found.append(o)
+        return found
+    
+    # get the entities whose center is in front of a position facing a direction:
+    # up to reach[0] (x) / reach[1] (y) ahead and to both sides
+    def query_arc(self, center: tuple, facing: str, reach: tuple):
+        d = FACING_DIRECTIONS[facing]
+        ahead, side = (reach[0], reach[1]) if d[0] else (reach[1], reach[0])
+        if d[0]:
+            rect = (center[0] if d[0] > 0 else center[0] - ahead, center[1] - side, ahead, side * 2)
+        else:
+            rect = (center[0] - side, center[1] if d[1] > 0 else center[1] - ahead, side * 2, ahead)
+        found = [].copy()
+        for o in self.query(rect[:2], rect[2:]):
+            c = self.get_center(o)
+            dx = c[0] - center[0]
+            dy = c[1] - center[1]
+            forward = dx * d[0] + dy * d[1]
+            lateral = dy if d[0] else dx
+            if 0 < forward < ahead and -side < lateral < side:
+                found.append(o)
+        return found
+
+
+# Class for a declarative TriggerZone (rect, radius, union or always) of an enemy
+class TriggerZone:
+    __slots__ = ("type", "start", "end", "center", "radius", "zones")
+    
     def __init__(self, init_dict: dict):
-        self.init_dict = init_dict
-        super().__init__(self.init_dict["start"], 
-            (self.init_dict["end"][0] - self.init_dict["start"][0],
-             self.init_dict["end"][1] - self.init_dict["start"][1]))
-        self.type = self.init_dict["type"]
+        self.type = init_dict["type"]
+        if self.type == "rect":
+            start = init_dict.get("start", [None, None])
+            end = init_dict.get("end", [None, None])
+            self.start = [-math.inf if c is None else c for c in start]
+            self.end = [math.inf if c is None else c for c in end]
+        elif self.type == "radius":
+            self.center = init_dict["center"]
+            self.radius = init_dict["radius"]
+        elif self.type == "union":
+            self.zones = [TriggerZone(z) for z in init_dict["zones"]]
+        elif self.type != "always":
+            raise ValueError(f"unknown trigger zone type '{self.type}'")
+
+    def contains(self, pos):
+        if self.type == "rect":
+            return self.start[0] <= pos[0] < self.end[0] and self.start[1] <= pos[1] < self.end[1]
+        if self.type == "radius":
+            return math.hypot(pos[0] - self.center[0], pos[1] - self.center[1]) <= self.radius
+        if self.type == "union":
+            return any(z.contains(pos) for z in self.zones)
+        return True
+
+    def get_bounds(self):
+        if self.type == "rect":
+            return (self.start[0], self.start[1], self.end[0], self.end[1])
+        if self.type == "radius":
+            return (self.center[0] - self.radius, self.center[1] - self.radius, self.center[0] + self.radius, self.center[1] + self.radius)
+        return (-math.inf, -math.inf, math.inf, math.inf)
+
+    # check if the zone contains every point of a cell
+    def covers(self, x0, y0, x1, y1):
+        if self.type == "rect":
+            return self.start[0] <= x0 and x1 <= self.end[0] and self.start[1] <= y0 and y1 <= self.end[1]
+        if self.type == "radius":
+            return all(math.hypot(x - self.center[0], y - self.center[1]) <= self.radius for x in (x0, x1) for y in (y0, y1))
+        if self.type == "union":
+            return any(z.covers(x0, y0, x1, y1) for z in self.zones)
+        return True
+
+    # check if the zone contains any point of a cell
+    def intersects(self, x0, y0, x1, y1):
+        if self.type == "rect":
+            return self.start[0] < x1 and x0 < self.end[0] and self.start[1] < y1 and y0 < self.end[1]
+        if self.type == "radius":
+            dx = max(x0 - self.center[0], 0, self.center[0] - x1)
+            dy = max(y0 - self.center[1], 0, self.center[1] - y1)
+            return math.hypot(dx, dy) <= self.radius
+        if self.type == "union":
+            return any(z.intersects(x0, y0, x1, y1) for z in self.zones)
+        return True
+
+    def to_data(self):
+        if self.type == "rect":
+            return {"type": "rect", "start": [None if math.isinf(c) else c for c in self.start], "end": [None if math.isinf(c) else c for c in self.end]}
+        if self.type == "radius":
+            return {"type": "radius", "center": self.center, "radius": self.radius}
+        if self.type == "union":
+            return {"type": "union", "zones": [z.to_data() for z in self.zones]}
+        return {"type": self.type}
+
+    def __repr__(self):
+        return f"TriggerZone({self.to_data()})"
+
+    def __str__(self):
+        return self.__repr__()
+
+
+# Class for the TriggerIndex of a level, mapping grid cells to the enemies triggered there
+class TriggerIndex:
+    def __init__(self, level_size: tuple, cell_size: int = 128):
+        self.level_size = level_size
+        self.cell_size = cell_size
+        self.full_cells = {}.copy()
+        self.partial_cells = {}.copy()
+        self.cell = None
+        self.partial = [].copy()
+        self.always = [].copy()
+
+    def insert(self, enemy, zone: TriggerZone):
+        # zones covering the whole level are not rasterized, they trigger on the first update
+        if zone.type == "always":
+            self.always.append(enemy)
+            return
+        bounds = zone.get_bounds()
+        x0 = max(0, int(max(bounds[0], 0)) // self.cell_size)
+        y0 = max(0, int(max(bounds[1], 0)) // self.cell_size)
+        x1 = int(min(bounds[2], self.level_size[0])) // self.cell_size
+        y1 = int(min(bounds[3], self.level_size[1])) // self.cell_size
+        for x in range(x0, x1 + 1):
+            for y in range(y0, y1 + 1):
+                cell = (x * self.cell_size, y * self.cell_size, (x + 1) * self.cell_size, (y + 1) * self.cell_size)
+                if zone.covers(*cell):
+                    self.full_cells.setdefault((x, y), [].copy()).append(enemy)
+                elif zone.intersects(*cell):
+                    self.partial_cells.setdefault((x, y), [].copy()).append((enemy, zone))
+
+    # trigger the enemies at the player's position, returns True if any enemy got triggered
+    def update(self, pos):
+        triggered = False
+        if self.always:
+            for e in self.always:
+                if not e.triggered:
+                    e.triggered = True
+                    triggered = True
+            self.always = [].copy()
+        cell = (int(pos[0]) // self.cell_size, int(pos[1]) // self.cell_size)
+        if cell != self.cell:
+            self.cell = cell
+            for e in self.full_cells.get(cell, [].copy()):
+                if not e.triggered:
+                    e.triggered = True
+                    triggered = True
+            self.partial = [(e, z) for e, z in self.partial_cells.get(cell, [].copy()) if not e.triggered]
+        if self.partial:
+            for e, z in self.partial:
+                if not e.triggered and z.contains(pos):
+                    e.triggered = True
+                    triggered = True
+            self.partial = [(e, z) for e, z in self.partial if not e.triggered]
+        return triggered
+
+
+# Class for the NavGrid of a level: its obstacle rectangles rasterized into blocked cells once,
+# and a flow field pointing every free cell to its next cell on a shortest path to the player
+class NavGrid:
+    NEIGHBOURS = ((1, 0), (-1, 0), (0, 1), (0, -1), (1, 1), (1, -1), (-1, 1), (-1, -1))
+    
+    def __init__(self, level_size: tuple, obstacles: list, cell_size: int = 32):
+        self.cell_size = cell_size
+        self.columns = -(-level_size[0] // cell_size)
+        self.rows = -(-level_size[1] // cell_size)
+        self.blocked = bytearray(self.columns * self.rows)
+        for o in obstacles:
+            x0 = max(0, int(o.pos[0]) // cell_size)
+            y0 = max(0, int(o.pos[1]) // cell_size)
+            x1 = min(self.columns - 1, int(o.pos[0] + o.size[0] - 1) // cell_size)
+            y1 = min(self.rows - 1, int(o.pos[1] + o.size[1] - 1) // cell_size)
+            for y in range(y0, y1 + 1):
+                self.blocked[y * self.columns + x0:y * self.columns + x1 + 1] = b"\1" * (x1 - x0 + 1)
+        self.target_cell = None
+        self.next = [-1] * (self.columns * self.rows)
+        if np is not None:
+            self.blocked_array = np.frombuffer(bytes(self.blocked), dtype=np.uint8).astype(bool)
+            self.next_array = np.full(self.columns * self.rows, -1)
+    
+    # get the index of the cell at a level position, -1 outside the level
+    def get_cell(self, pos: tuple):
+        x = int(pos[0] // self.cell_size)
+        y = int(pos[1] // self.cell_size)
+        if 0 <= x < self.columns and 0 <= y < self.rows:
+            return y * self.columns + x
+        return -1
+    
+    def get_center(self, cell: int):
+        return ((cell % self.columns + 0.5) * self.cell_size, (cell // self.columns + 0.5) * self.cell_size)
+    
+    # recompute the flow field by a breadth first search from the target's cell, only when that cell changed
+    def update(self, target: tuple):
+        cell = self.get_cell(target)
+        if cell == self.target_cell:
+            return
+        self.target_cell = cell
+        self.next = [-1] * (self.columns * self.rows)
+        if cell >= 0:
+            self.next[cell] = cell
+            queue = [cell]
+            for c in queue:
+                x, y = c % self.columns, c // self.columns
+                for dx, dy in self.NEIGHBOURS:
+                    nx, ny = x + dx, y + dy
+                    if not (0 <= nx < self.columns and 0 <= ny < self.rows):
+                        continue
+                    n = ny * self.columns + nx
+                    if self.next[n] >= 0 or self.blocked[n]:
+                        continue
+                    # diagonal steps must not cut a blocked corner
+                    if dx and dy and (self.blocked[y * self.columns + nx] or self.blocked[ny * self.columns + x]):
+                        continue
+                    self.next[n] = c
+                    queue.append(n)
+        if np is not None:
+            self.next_array = np.array(self.next)
+    
+    # check if the straight line between two positions crosses no blocked cell
+    def is_clear(self, a: tuple, b: tuple):
+        steps = int(math.hypot(b[0] - a[0], b[1] - a[1]) * 2 // self.cell_size) + 1
+        for i in range(1, steps):
+            cell = self.get_cell((a[0] + (b[0] - a[0]) * i / steps, a[1] + (b[1] - a[1]) * i / steps))
+            if cell >= 0 and self.blocked[cell]:
+                return False
+        return True
+    
+    # get the position to head for from start on the way to target: the target itself if it is in sight
+    # (or out of reach), else the center of the next cell in the flow field
+    def get_target(self, start: tuple, target: tuple):
+        if self.is_clear(start, target):
+            return target
+        self.update(target)
+        cell = self.get_cell(start)
+        if cell < 0 or self.next[cell] < 0:
+            return target
+        return self.get_center(self.next[cell])
+    
+    # get_target for an array of start positions at once (NumPy)
+    def get_targets(self, starts, target):
+        targets = np.repeat(np.asarray(target, dtype=float)[None, :], len(starts), axis=0)
+        if not len(starts):
+            return targets
+        delta = targets - starts
+        # the same samples as is_clear, padded to the longest line
+        steps = (np.hypot(delta[:, 0], delta[:, 1]) * 2 // self.cell_size).astype(int) + 1
+        i = np.arange(1, steps.max())
+        samples = starts[:, None, :] + delta[:, None, :] * i[None, :, None] / steps[:, None, None]
+        cells = self.get_cells(samples.reshape(-1, 2)).reshape(len(starts), -1)
+        blocked = (cells >= 0) & self.blocked_array[np.maximum(cells, 0)] & (i[None, :] < steps[:, None])
+        hidden = np.flatnonzero(blocked.any(axis=1))
+        if len(hidden):
+            self.update(target)
+            cells = self.get_cells(starts[hidden])
+            following = np.flatnonzero((cells >= 0) & (self.next_array[np.maximum(cells, 0)] >= 0))
+            if len(following):
+                nxt = self.next_array[cells[following]]
+                targets[hidden[following], 0] = (nxt % self.columns + 0.5) * self.cell_size
+                targets[hidden[following], 1] = (nxt // self.columns + 0.5) * self.cell_size
+        return targets
+    
+    # get_cell for an array of positions, -1 outside the level
+    def get_cells(self, positions):
+        x = np.floor_divide(positions[:, 0], self.cell_size).astype(int)
+        y = np.floor_divide(positions[:, 1], self.cell_size).astype(int)
+        inside = (x >= 0) & (x < self.columns) & (y >= 0) & (y < self.rows)
+        return np.where(inside, y * self.columns + x, -1)
+
+
+# Class for the packed ObstacleHitboxes of a level: one array of their rectangles (x, y, w, h)
+# and one of their type ids, instead of an object per hitbox
+class HitboxArray:
+    __slots__ = ("rects", "type_ids", "types")
+    
+    def __init__(self, init_dicts: list):
+        rects = [].copy()
+        self.types = [].copy()
+        type_ids = [].copy()
+        for d in init_dicts:
+            rects.extend((d["start"][0], d["start"][1], d["end"][0] - d["start"][0], d["end"][1] - d["start"][1]))
+            if d["type"] not in self.types:
+                self.types.append(d["type"])
+            type_ids.append(self.types.index(d["type"]))
+        self.rects = array("i" if all(isinstance(c, int) for c in rects) else "d", rects)
+        self.type_ids = array("H", type_ids)
+    
+    def get_rect(self, i: int):
+        return tuple(self.rects[i * 4:i * 4 + 4])
+    
+    def get_type(self, i: int):
+        return self.types[self.type_ids[i]]
+    
+    # check if hitbox i overlaps a rectangle, on the packed values without creating a view
+    def overlaps(self, i: int, pos, size):
+        r = self.rects
+        i *= 4
+        return r[i] < pos[0] + size[0] and pos[0] < r[i] + r[i + 2] and r[i + 1] < pos[1] + size[1] and pos[1] < r[i + 1] + r[i + 3]
+    
+    def __len__(self):
+        return len(self.type_ids)
+    
+    def __getitem__(self, i: int):
+        if not -len(self) <= i < len(self):
+            raise IndexError("hitbox index out of range")
+        return ObstacleHitbox(self, i % len(self))
+    
+    def __iter__(self):
+        for i in range(len(self)):
+            yield ObstacleHitbox(self, i)
+    
+    def __repr__(self):
+        return f"HitboxArray({len(self)} hitboxes)"
+    
+    def __str__(self):
+        return self.__repr__()
+
+
+# Class for an ObstacleHitbox in a level, a view on one rectangle of its HitboxArray
+class ObstacleHitbox:
+    __slots__ = ("hitboxes", "index")
+    
+    def __init__(self, hitboxes: HitboxArray, index: int):
+        self.hitboxes = hitboxes
+        self.index = index
+    
+    @property
+    def pos(self):
+        return self.hitboxes.get_rect(self.index)[:2]
+    
+    @property
+    def size(self):
+        return self.hitboxes.get_rect(self.index)[2:]
+    
+    @property
+    def type(self):
+        return self.hitboxes.get_type(self.index)
+    
+    def get_collision(self, o):
+        return self.hitboxes.overlaps(self.index, o.pos, o.size)
+
+    def to_data(self):
+        x, y, w, h = self.hitboxes.get_rect(self.index)
+        return {"type": self.type, "start": [x, y], "end": [x + w, y + h]}
 
     def get_hitbox_surface(self):
         return Surface(self.size, Color(0, 255, 255, 63))
@@ -105,8 +948,14 @@ class ObstacleHitbox(Position):
     def get_hitbox_screen_object(self, bg_pos):
         return ScreenObject(self.get_hitbox_surface()).set((bg_pos[0] + self.pos[0], bg_pos[1] + self.pos[1]))
 
+    def __eq__(self, o):
+        return isinstance(o, ObstacleHitbox) and o.hitboxes is self.hitboxes and o.index == self.index
+
+    def __hash__(self):
+        return hash((id(self.hitboxes), self.index))
+
     def __repr__(self):
-        return f"Obstacle({self.init_dict})"
+        return f"Obstacle({self.to_data()})"
 
     def __str__(self):
         return self.__repr__()
@@ -115,15 +964,15 @@ class ObstacleHitbox(Position):
 # Class for an InteractableObject in a level
 class InteractableObject(Position):
     def __init__(self, init_dict: dict):
-        self.init_dict = init_dict
-        self.type = self.init_dict["type"]
-        self.pos = self.init_dict["pos"]
-        self.image_file = self.init_dict["image"]
-        self.image = Image(self.image_file)
+        self.type = init_dict["type"]
+        self.pos = init_dict["pos"]
+        self.image_file = init_dict["image"]
+        self.image = ASSETS.get(self.image_file)
         super().__init__(self.pos, self.image.size)
         self.layer = 4
-        self.description = self.init_dict["description"]
-        self.actions = self.init_dict["actions"]
+        self.description = init_dict["description"]
+        # compile the actions now, so activating one never loads anything
+        self.actions = [Action(a) for a in init_dict["actions"]]
 
     def get_surface(self):
         return self.image
@@ -148,31 +997,51 @@ class InteractableObject(Position):
     def get_action_menu(self):
         return ActionMenu(self.actions, self.description)
 
+    def to_data(self):
+        return {"type": self.type, "pos": self.pos, "image": self.image_file, "description": self.description, "actions": [a.to_data() for a in self.actions]}
+
     def __repr__(self):
-        return f"Obstacle({self.init_dict})"
+        return f"Obstacle({self.to_data()})"
 
     def __str__(self):
         return self.__repr__()
 
 
 # Class for an Item
+# Its surface is rendered when it is first shown, and again only after its count changed
 class Item:
+    __slots__ = ("type", "count", "slot", "data", "surface", "surface_count")
+    
     def __init__(self, t: str, count: int = 1, slot: str = "secondary", data: dict = {}.copy()):
         self.type = t
         self.count = count
         self.slot = slot
         self.data = data.copy()
         self.surface = None
-        self.update_surface()
+        self.surface_count = None
 
     def update_surface(self):
         self.surface = Surface((96, 96))
-        self.surface.blit(Image("items/" + self.type + ".png", (96, 96)), (0, 0))
-        self.surface.blit(Text(MSG["item."+self.type], COLORS.light_grey), (48, 72), (True, False))
-        if self.count > 1: self.surface.blit(Text(str(self.count), COLORS.light_grey, font_size=1.5), (4, 68), (False, False))
+        self.surface.blit(ASSETS.get("items/" + self.type + ".png", (96, 96)), (0, 0))
+        self.surface.blit(cached_text(MSG["item."+self.type], COLORS.light_grey), (48, 72), (True, False))
+        if self.count > 1: self.surface.blit(cached_text(str(self.count), COLORS.light_grey, font_size=1.5), (4, 68), (False, False))
+        self.surface_count = self.count
     
     def get_surface(self):
+        if self.surface is None or self.surface_count != self.count:
+            self.update_surface()
         return self.surface
+    
+    # check if another item can go onto this item's stack
+    def stacks_with(self, item):
+        return item.type == self.type and item.slot == self.slot and item.data == self.data
+    
+    # get the rest of the stack after taking count items
+    def reduce(self, count: int):
+        return Item(self.type, self.count - count, self.slot, self.data)
+    
+    def to_data(self):
+        return {"$type": "Item", "type": self.type, "count": self.count, "slot": self.slot, "data": self.data}
         
     def __repr__(self):
         return f"Item('{self.type}', {self.count}, '{self.slot}', {self.data})"
@@ -182,59 +1051,165 @@ class Item:
 
 
 # Class for an ItemContainer, like a chest
+# Its items are shown in pages of 4x4 slots, a removed item leaves an empty slot (None) the next added item fills,
+# and only the buttons of the changed slot are rebuilt
 class ItemContainer:
+    COLUMNS = 4
+    ROWS = 4
+    SLOT_SIZE = 96
+    PAGE_BAR_HEIGHT = 32
+    
     def __init__(self, init_dict: dict = {"items": [].copy()}.copy()):
-        self.init_dict = init_dict
-        self.items = self.init_dict["items"]
+        self.items = list(init_dict["items"])
+        self.page = 0
+        # the InteractableObject on the ground holding the container, for dropped loot
+        self.loot = None
         self.update_surface()
 
+    def get_page_size(self):
+        return self.COLUMNS * self.ROWS
+
+    def get_page_count(self):
+        return max(1, -(-len(self.items) // self.get_page_size()))
+
     def add_item(self, item: Item):
-        self.items.append(item)
+        pages = self.get_page_count()
+        if None in self.items:
+            n = self.items.index(None)
+            self.items[n] = item
+        else:
+            n = len(self.items)
+            self.items.append(item)
+        if self.get_page_count() != pages:
+            self.update_surface()
+        else:
+            self.update_slot(n)
         return self
 
+    def add_items(self, items: list):
+        for i in items:
+            self.add_item(i)
+        return self
+
+    # remove item.count items of item's type, taking part of the stack if it has more
+    # the stack of the item itself if it is in the container, else the first one of its type
     def remove_item(self, item: Item):
-        for i in self.items:
-            if i.type == item.type:
+        same = [n for n, i in enumerate(self.items) if i is item]
+        for n in same or range(len(self.items)):
+            i = self.items[n]
+            if i and i.type == item.type:
                 if i.count > item.count:
-                    self.items.remove(i)
-                    new = i.reduce(item.count)
-                    self.items.append(new)
+                    self.items[n] = i.reduce(item.count)
+                    self.update_slot(n)
                     return True
                 elif i.count == item.count:
-                    self.items.remove(i)
+                    pages = self.get_page_count()
+                    self.items[n] = None
+                    while self.items and self.items[-1] is None:
+                        self.items.pop()
+                    if self.get_page_count() != pages:
+                        self.page = min(self.page, self.get_page_count() - 1)
+                        self.update_surface()
+                    else:
+                        self.update_slot(n)
                     return True
                 else:
                     return False
+        return False
+
+    def turn_page(self, step: int):
+        page = max(0, min(self.get_page_count() - 1, self.page + step))
+        if page != self.page:
+            self.page = page
+            self.update_surface()
     
+    # build the panel and the buttons of the current page
     def update_surface(self):
-        self.screen_object = ScreenObject(Surface((96 * 4, 96 * 4), Color(0, 0, 0, 127))).set((WIDTH // 2, HEIGHT // 5 * 2), 6, (True, True))
-        for i in range(4):
-            for j in range(4):
-                self.screen_object.blit(Surface((90, 90), Color(0, 0, 0, 127)), (i*96+3, j*96+3))
-        self.buttons = [].copy()
-        for n, i in enumerate(self.items):
-            o = Button(i.get_surface(), alt_text=f'{MSG["item."+i.type]} [{MSG["item_slot."+i.slot]}]').set_pos_pseudo_screen((n % 4 * 96, n // 4 * 96), self.screen_object)
-            o.item = i
-            self.buttons.append(o)
+        size = self.SLOT_SIZE
+        pages = self.get_page_count()
+        panel = Surface((size * self.COLUMNS, size * self.ROWS + (self.PAGE_BAR_HEIGHT if pages > 1 else 0)), Color(0, 0, 0, 127))
+        for i in range(self.COLUMNS):
+            for j in range(self.ROWS):
+                panel.blit(Surface((size - 6, size - 6), Color(0, 0, 0, 127)), (i*size+3, j*size+3))
+        if pages > 1:
+            panel.blit(cached_text(f"{self.page + 1}/{pages}", COLORS.light_grey), (size * self.COLUMNS // 2, size * self.ROWS + self.PAGE_BAR_HEIGHT // 2), (True, True))
+        self.screen_object = ScreenObject(panel).set((WIDTH // 2 - size * self.COLUMNS // 2, HEIGHT // 5 * 2 - size * self.ROWS // 2), 6)
+        
+        self.slot_buttons = {}.copy()
+        first = self.page * self.get_page_size()
+        for n in range(first, min(len(self.items), first + self.get_page_size())):
+            if self.items[n]:
+                self.slot_buttons[n] = self.get_slot_button(n)
+        self.page_buttons = [].copy()
+        if pages > 1:
+            for step, label, x in ((-1, "<", 0), (1, ">", size * self.COLUMNS - 48)):
+                o = Button(Surface((48, self.PAGE_BAR_HEIGHT), Color(0, 0, 0, 127)), Surface((48, self.PAGE_BAR_HEIGHT), COLORS.dark_green)).set_pos_pseudo_screen((x, size * self.ROWS), self.screen_object)
+                o.blit_all(cached_text(label, COLORS.light_grey), (24, self.PAGE_BAR_HEIGHT // 2), (True, True))
+                o.item = None
+                o.step = step
+                self.page_buttons.append(o)
+        self.update_buttons()
+    
+    # rebuild the button of one slot, if it is on the current page
+    def update_slot(self, n: int):
+        first = self.page * self.get_page_size()
+        if first <= n < first + self.get_page_size():
+            if n < len(self.items) and self.items[n]:
+                self.slot_buttons[n] = self.get_slot_button(n)
+            else:
+                self.slot_buttons.pop(n, None)
+            self.update_buttons()
+    
+    def get_slot_button(self, n: int):
+        i = self.items[n]
+        k = n % self.get_page_size()
+        o = Button(i.get_surface(), alt_text=f'{MSG["item."+i.type]} [{MSG["item_slot."+i.slot]}]').set_pos_pseudo_screen((k % self.COLUMNS * self.SLOT_SIZE, k // self.COLUMNS * self.SLOT_SIZE), self.screen_object)
+        o.item = i
+        return o
+    
+    def update_buttons(self):
+        self.buttons = list(self.slot_buttons.values()) + self.page_buttons
     
     def get_screen_object(self):
         return self.screen_object
     
     def __repr__(self):
-        return "ItemContainer({'items': " + str(self.items) + "})"
+        return "ItemContainer({'items': " + str([i for i in self.items if i]) + "})"
     
     def __str__(self):
         return self.__repr__()
 
 
-# Class for the player's Inventory
+INVENTORY_SLOTS = ("primary", "secondary", "consumable")
+# the largest stack each inventory slot holds
+SLOT_CAPACITY = {"primary": 1, "secondary": 1, "consumable": 99}
+
+# Image of the loot left on the ground when the drops of an enemy don't fit into the inventory
+LOOT_IMAGE = "entities/loot.png"
+
+# Class for the player's Inventory: one stack per slot, indexed by item type
 class Inventory(Enum):
     def __init__(self, init_dict: dict = {}.copy()):
         super().__init__()
         self.set_with_dict(init_dict)
+        self.reindex()
+        self.touch()
+
+    # mark the inventory as changed, for the HUD
+    def touch(self):
+        self.version = next_version()
+
+    def reindex(self):
+        self.type_index = {self.content[k].type: k for k in INVENTORY_SLOTS if self.content.get(k)}
+
+    def to_data(self):
+        data = {"$type": "Inventory"}
+        for k in INVENTORY_SLOTS:
+            data[k] = self.content[k].to_data() if self.content.get(k) else None
+        return data
 
     def __repr__(self):
-        return f"Inventory({self.content})"
+        return f"Inventory({ {k: self.content.get(k) for k in INVENTORY_SLOTS} })"
 
     def __str__(self):
         return self.__repr__()
@@ -244,6 +1219,8 @@ class Inventory(Enum):
         self.set(primary = None)
         self.set(secondary = None)
         self.set(consumable = None)
+        self.reindex()
+        self.touch()
         return self
     
     def set_item(self, item: Item, slot: str = "primary"):
@@ -252,22 +1229,81 @@ class Inventory(Enum):
         else:
             r = None
         self.content[slot] = item
+        self.reindex()
+        self.touch()
         return r
+    
+    # get the stack of an item type, None if there is none
+    def find(self, t: str):
+        slot = self.type_index.get(t)
+        return self.content[slot] if slot else None
+    
+    def count(self, t: str):
+        item = self.find(t)
+        return item.count if item else 0
+    
+    # add items to the inventory, merging them into the stacks of their type up to the slot's capacity
+    # an item of another type in the slot is swapped out if replace, else the new item is left over
+    # returns the items that did not fit (left over and swapped out)
+    def add_items(self, items: list, replace: bool = False):
+        rest = [].copy()
+        for item in items:
+            capacity = SLOT_CAPACITY.get(item.slot, 1)
+            current = self.content.get(item.slot)
+            if current and current.stacks_with(item):
+                taken = max(0, min(capacity - current.count, item.count))
+                current.count += taken
+                if taken < item.count:
+                    rest.append(item.reduce(taken) if taken else item)
+                continue
+            if current and not replace:
+                rest.append(item)
+                continue
+            if current:
+                rest.append(current)
+            if item.count > capacity:
+                rest.append(item.reduce(capacity))
+                item = item.reduce(item.count - capacity)
+            self.content[item.slot] = item
+        self.reindex()
+        self.touch()
+        return rest
+    
+    def add_item(self, item: Item, replace: bool = False):
+        return self.add_items([item], replace)
+    
+    # remove counts of item types ({type: count}), only if the inventory has all of them; returns True if removed
+    def remove_items(self, counts: dict):
+        if any(self.count(t) < n for t, n in counts.items()):
+            return False
+        for t, n in counts.items():
+            slot = self.type_index[t]
+            if self.content[slot].count > n:
+                self.content[slot].count -= n
+            else:
+                self.content[slot] = None
+        self.reindex()
+        self.touch()
+        return True
+    
+    def remove_item(self, t: str, count: int = 1):
+        return self.remove_items({t: count})
             
 
 # Class for the Player
 class Player:
     def __init__(self, init_level):
         self.pos = init_level.starting_pos
+        self.prev_pos = tuple(self.pos)
         self.screen_pos = [WIDTH // 2, HEIGHT // 2]
         self.update_surface()
     
     def update_surface(self):
         self.surfaces = {}.copy()
-        self.surfaces["front"] = Image("player/player-front.png")
-        self.surfaces["back"] = Image("player/player-back.png")
-        self.surfaces["left"] = Image("player/player-left.png")
-        self.surfaces["right"] = Image("player/player-right.png")
+        self.surfaces["front"] = ASSETS.get("player/player-front.png")
+        self.surfaces["back"] = ASSETS.get("player/player-back.png")
+        self.surfaces["left"] = ASSETS.get("player/player-left.png")
+        self.surfaces["right"] = ASSETS.get("player/player-right.png")
         self.facing = "front"
         self.surface = self.surfaces["front"]
         self.collision_size = (self.surface.size[0], 1)
@@ -278,18 +1314,23 @@ class Player:
     def get_screen_object(self):
         return ScreenObject(self.get_surface()).set(self.screen_pos, 4, (True, True))
     
+    # position between the last two ticks, for rendering
+    def get_render_pos(self):
+        return interpolate(self.prev_pos, self.pos)
+    
     def get_background_pos(self):
-        return (WIDTH // 2 - self.pos[0] - self.surface.size[0] // 2, HEIGHT // 2 - self.pos[1] - self.surface.size[1] // 2)
+        pos = self.get_render_pos()
+        return (WIDTH // 2 - pos[0] - self.surface.size[0] // 2, HEIGHT // 2 - pos[1] - self.surface.size[1] // 2)
     
     def get_screen_pos(self):
         return self.screen_pos
     
     def move(self, movement: tuple = (0, 0)):
-        for o in GLOBALS.level.obstacle_hitboxes:
-            if o.get_collision(Position((self.pos[0] + movement[0], self.pos[1] + self.surface.size[1] + movement[1]), self.collision_size)):
-                return
-        for o in GLOBALS.level.interactable_objects:
-            if o.get_collision(Position((self.pos[0] + movement[0], self.pos[1] + self.surface.size[1] + movement[1]), self.collision_size)):
+        hitbox = Position((self.pos[0] + movement[0], self.pos[1] + self.surface.size[1] + movement[1]), self.collision_size)
+        if GLOBALS.level.obstacle_grid.collides(hitbox.pos, hitbox.size):
+            return
+        for o in GLOBALS.level.interactable_grid.query(hitbox.pos, hitbox.size):
+            if o.get_collision(hitbox):
                 o.activate()
                 return
         old_pos = self.pos
@@ -316,8 +1357,9 @@ class Player:
         close_action_menu()
         close_container()
     
-    def collect_item(self, item: Item):
-        return SAVESTATE.inventory.set_item(item, item.slot)
+    # put items into the inventory, returns the items that did not fit
+    def collect_items(self, items: list, replace: bool = False):
+        return SAVESTATE.inventory.add_items(items, replace)
     
     def collides_edge(self):
         if self.pos[0] // 2 < 0 or self.pos[0] + self.surface.size[0] > GLOBALS.level.get_size()[0]:
@@ -327,16 +1369,53 @@ class Player:
     
     def damage(self, hp):
         if SAVESTATE.hp > hp:
-            SAVESTATE.hp -= hp
+            set_hp(SAVESTATE.hp - hp)
         else:
-            SAVESTATE.hp = 0
+            set_hp(0)
             game_over()
             
     def heal(self, hp):
-        if SAVESTATE.hp + hp > 100:
-            SAVESTATE.hp = 100
-        else:
-            SAVESTATE.hp += hp
+        set_hp(min(SAVESTATE.hp + hp, 100))
+
+
+# Get the predicate of an action's "required" items ({slot: item type}) on an Inventory
+def compile_requirement(required: dict = None):
+    if not required:
+        return lambda inventory: True
+    required = tuple(required.items())
+    return lambda inventory: all(inventory.content[k] and inventory.content[k].type == t for k, t in required)
+
+
+# Class for an Action of an InteractableObject, compiled at level load:
+# its requirement predicate and whatever its type prepares (e.g. the object a transform turns into),
+# the action's level data isn't kept
+class Action:
+    __slots__ = ("type", "name", "requirement", "required_dialog", "target")
+    
+    def __init__(self, content: dict):
+        self.type = content["type"]
+        self.name = content["name"]
+        if self.type not in ACTIONS:
+            raise ValueError(f"unknown action type '{self.type}'")
+        self.requirement = compile_requirement(content.get("required"))
+        self.required_dialog = content.get("required_dialog")
+        prepare = ACTIONS[self.type][1]
+        self.target = prepare(content) if prepare else None
+    
+    def is_allowed(self):
+        return self.requirement(SAVESTATE.inventory)
+    
+    def run(self):
+        ACTIONS[self.type][0](self)
+    
+    def to_data(self):
+        return {"type": self.type, "name": self.name}
+    
+    def __repr__(self):
+        return f"Action({self.to_data()})"
+    
+    def __str__(self):
+        return self.__repr__()
 
 
 # Class for an ActionMenu when activating an InteractableObject
@@ -351,7 +1430,7 @@ class ActionMenu:
         self.buttons = [].copy()
         for n, i in enumerate(self.contents):
             o = Button(Surface((400, 70), Color(0, 0, 0, 127)), Surface((400, 70), COLORS.dark_green)).set_pos_pseudo_screen((0, n*70), self.screen_object)
-            o.blit_all(Text(MSG[i["name"]], COLORS.light_grey, font_size=2), (200, 35), (True, True))
+            o.blit_all(cached_text(MSG[i.name], COLORS.light_grey, font_size=2), (200, 35), (True, True))
             o.content = i
             self.buttons.append(o)
 
@@ -359,19 +1438,184 @@ class ActionMenu:
         return self.screen_object
 
 
-# Class for Enemies to fight
+# Get a Python number from a batch column value, integral values as int
+def batch_number(value):
+    value = float(value)
+    return int(value) if value.is_integer() else value
+
+# Get a property of an Enemy stored in a column of its EnemyBatch
+# kind: "point" (live [x, y] row), "tuple" (point copied as a tuple), "number" or "flag"
+def batch_column(name: str, kind: str):
+    def get(self):
+        value = getattr(self.batch, name)[self.index]
+        if kind == "tuple":
+            return (float(value[0]), float(value[1]))
+        if kind == "number":
+            return batch_number(value)
+        if kind == "flag":
+            return bool(value)
+        return value
+    def set(self, value):
+        column = getattr(self.batch, name)
+        if kind in ("point", "tuple") and not self.batch.numpy:
+            column[self.index] = [value[0], value[1]]
+        else:
+            column[self.index] = value
+    return property(get, set)
+
+
+# Class for the EnemyBatch of a level: the state of all enemies as columns (structure of arrays),
+# advanced for all triggered enemies in one step per tick, NumPy arrays if available, else lists
+class EnemyBatch:
+    def __init__(self, init_dicts: list, numpy_min_size: int = 16):
+        n = len(init_dicts)
+        # for a handful of enemies the plain loop is faster than NumPy's per call overhead
+        self.numpy = np is not None and n >= numpy_min_size
+        for name in ("pos", "prev_pos", "attack_orig", "attack_target"):
+            setattr(self, name, np.zeros((n, 2)) if self.numpy else [[0.0, 0.0] for i in range(n)])
+        for name in ("speed", "hp", "move_timeout", "current_move_timeout", "attack_animation_frame", "current_attack_timeout"):
+            setattr(self, name, np.zeros(n) if self.numpy else [0] * n)
+        for name in ("triggered", "pursuit", "attacking"):
+            setattr(self, name, np.zeros(n, dtype=bool) if self.numpy else [False] * n)
+        self.alive = np.ones(n, dtype=bool) if self.numpy else [True] * n
+        
+        self.enemies = [Enemy(d, self, i) for i, d in enumerate(init_dicts)]
+        
+        # the living enemies by position, updated after every tick
+        self.hash = EntityHash()
+        for e in self.enemies:
+            self.hash.insert(e)
+        
+        # constant columns of the batched update
+        if self.numpy:
+            self.half_size = np.array([(e.surface.size[0] // 2, e.surface.size[1] // 2) for e in self.enemies], dtype=float).reshape(n, 2)
+            self.attack_frames = np.array([e.attack["frames"] for e in self.enemies], dtype=float)
+            self.attack_timeout = np.array([e.attack["timeout"] for e in self.enemies], dtype=float)
+            self.attack_jump = np.array([e.attack["type"] == "jump" for e in self.enemies], dtype=bool)
+    
+    def remove(self, e):
+        self.alive[e.index] = False
+        self.hash.remove(e)
+    
+    # remember the positions before a tick, for interpolation
+    def snapshot(self):
+        if self.numpy:
+            self.prev_pos[:] = self.pos
+        else:
+            for e in self.enemies:
+                e.prev_pos = e.pos
+    
+    # check if a triggered enemy moved in the last tick
+    def is_moving(self):
+        if self.numpy:
+            active = self.alive & self.triggered
+            return bool((self.prev_pos[active] != self.pos[active]).any())
+        return any(e.prev_pos != tuple(e.pos) for e in self.enemies if self.alive[e.index] and e.triggered)
+    
+    # advance all triggered enemies by one tick: move timeouts, pursuit, attacks; returns True if any changed
+    def update(self):
+        if not self.numpy:
+            active = [e for e in self.enemies if self.alive[e.index] and e.triggered]
+            for e in active:
+                if e.pursuit:
+                    e.current_move_timeout -= 1
+                    if e.current_move_timeout <= 0:
+                        e.calculate_move()
+                        GLOBALS.update_view = True
+                e.update_attack_animation()
+            self.hash.move(active)
+            return False
+        
+        active = self.alive & self.triggered
+        if not active.any():
+            return False
+        changed = False
+        player = GLOBALS.player
+        
+        # pursuing enemies whose move timeout ran out step toward the player, or attack when close
+        pursuing = active & self.pursuit
+        self.current_move_timeout[pursuing] -= 1
+        due = np.flatnonzero(pursuing & (self.current_move_timeout <= 0))
+        if len(due):
+            changed = True
+            target = np.array((player.pos[0] + player.surface.size[0] // 2, player.pos[1] + player.surface.size[1] // 2), dtype=float)
+            starts = self.pos[due] + self.half_size[due]
+            delta = target - starts
+            dist = np.hypot(delta[:, 0], delta[:, 1])
+            far = dist > 100
+            moving = due[far]
+            # walk around obstacles, toward the next cell of the level's flow field
+            delta = GLOBALS.level.nav_grid.get_targets(starts[far], target) - starts[far]
+            dist = np.hypot(delta[:, 0], delta[:, 1])
+            self.pos[moving] += np.minimum(self.speed[moving], dist)[:, None] * delta / np.where(dist > 0, dist, 1)[:, None]
+            self.hash.move([self.enemies[i] for i in moving])
+            self.start_attacks(due[~far], player.pos)
+            self.current_move_timeout[due] = self.move_timeout[due]
+        
+        # attack timeouts and jump animations
+        timed = active & (self.current_attack_timeout > 0)
+        self.current_attack_timeout[timed] -= 1
+        jumping = active & self.attack_jump
+        forward = np.flatnonzero(jumping & self.attacking)
+        back = np.flatnonzero(jumping & ~self.attacking & (self.attack_animation_frame > 0))
+        if len(forward) or len(back):
+            changed = True
+            self.attack_animation_frame[forward] += 1
+            self.attack_animation_frame[back] -= 1
+            self.animate_jumps(np.concatenate((forward, back)))
+            self.hash.move([self.enemies[i] for i in np.concatenate((forward, back))])
+            # the jumps that landed hit the player, in enemy order
+            for i in forward[self.attack_animation_frame[forward] >= self.attack_frames[forward]]:
+                self.enemies[i].attack_player()
+        return changed
+    
+    def start_attacks(self, index, player_pos: tuple):
+        ready = index[~self.attacking[index] & (self.attack_animation_frame[index] == 0) & (self.current_attack_timeout[index] <= 0)]
+        self.current_attack_timeout[ready] = self.attack_timeout[ready]
+        jump = ready[self.attack_jump[ready]]
+        self.attacking[jump] = True
+        self.attack_orig[jump] = self.pos[jump]
+        self.attack_target[jump] = player_pos
+    
+    def animate_jumps(self, index):
+        delta = self.attack_target[index] - self.attack_orig[index]
+        dist = np.hypot(delta[:, 0], delta[:, 1])
+        moved = np.minimum(dist / self.attack_frames[index] * self.attack_animation_frame[index], dist)
+        self.pos[index] = self.attack_orig[index] + moved[:, None] * delta / np.where(dist > 0, dist, 1)[:, None]
+
+
+# Class for Enemies to fight, a view on one row of their level's EnemyBatch
 class Enemy:
-    def __init__(self, init_dict: dict):
-        self.init_dict = init_dict.copy()
-        self.pos = self.init_dict["start_pos"]
-        self.orig_pos = self.pos.copy()
-        self.trigger = self.init_dict["trigger"]
-        self.pursuit = self.init_dict["pursuit"]
-        self.attack = self.init_dict["attack"]
-        self.speed = self.init_dict["speed"]
-        self.hp = self.init_dict["hp"]
-        self.drops = self.init_dict["drops"].copy() if "drops" in self.init_dict else [].copy()
-        self.move_timeout = self.init_dict["move_timeout"]
+    pos = batch_column("pos", "point")
+    prev_pos = batch_column("prev_pos", "tuple")
+    attack_orig = batch_column("attack_orig", "point")
+    attack_target = batch_column("attack_target", "point")
+    speed = batch_column("speed", "number")
+    hp = batch_column("hp", "number")
+    move_timeout = batch_column("move_timeout", "number")
+    current_move_timeout = batch_column("current_move_timeout", "number")
+    attack_animation_frame = batch_column("attack_animation_frame", "number")
+    current_attack_timeout = batch_column("current_attack_timeout", "number")
+    triggered = batch_column("triggered", "flag")
+    pursuit = batch_column("pursuit", "flag")
+    attacking = batch_column("attacking", "flag")
+    
+    __slots__ = ("batch", "index", "image", "orig_pos", "trigger", "attack", "drops", "surface")
+    
+    def __init__(self, init_dict: dict, batch: EnemyBatch, index: int):
+        self.batch = batch
+        self.index = index
+        self.image = init_dict["image"]
+        self.pos = init_dict["start_pos"]
+        self.orig_pos = init_dict["start_pos"].copy()
+        self.prev_pos = self.pos
+        self.trigger = TriggerZone(init_dict["trigger"])
+        self.pursuit = init_dict["pursuit"]
+        self.attack = init_dict["attack"]
+        self.speed = init_dict["speed"]
+        self.hp = init_dict["hp"]
+        self.drops = init_dict["drops"].copy() if "drops" in init_dict else [].copy()
+        self.move_timeout = init_dict["move_timeout"]
         self.current_move_timeout = self.move_timeout
         self.triggered = False
         self.attacking = False
@@ -380,13 +1624,17 @@ class Enemy:
         self.update_surface()
     
     def update_surface(self):
-        self.surface = Image(self.init_dict["image"])
+        self.surface = ASSETS.get(self.image)
         
     def get_screen_object(self):
         return ScreenObject(self.surface).set(self.pos, 4)
     
     def check_trigger(self):
-        return eval(self.trigger)
+        return self.trigger.contains(GLOBALS.player.pos)
+    
+    # position between the last two ticks, for rendering
+    def get_render_pos(self):
+        return interpolate(self.prev_pos, tuple(self.pos))
     
     def calculate_move(self):
         start = (self.pos[0] + self.surface.size[0] // 2, self.pos[1] + self.surface.size[1] // 2)
@@ -395,9 +1643,15 @@ class Enemy:
         dy = target[1] - start[1]
         dist = math.hypot(dx, dy)
         if dist > 100:
-            move_x = min(self.speed, dist) * dx / dist
-            move_y = min(self.speed, dist) * dy / dist
-            self.move((move_x, move_y))
+            # walk around obstacles, toward the next cell of the level's flow field
+            waypoint = GLOBALS.level.nav_grid.get_target(start, target)
+            dx = waypoint[0] - start[0]
+            dy = waypoint[1] - start[1]
+            dist = math.hypot(dx, dy)
+            if dist > 0:
+                move_x = min(self.speed, dist) * dx / dist
+                move_y = min(self.speed, dist) * dy / dist
+                self.move((move_x, move_y))
         else:
             self.start_attack()
         self.current_move_timeout = self.move_timeout
@@ -414,6 +1668,9 @@ class Enemy:
         dx = self.attack_target[0] - self.attack_orig[0]
         dy = self.attack_target[1] - self.attack_orig[1]
         dist = math.hypot(dx, dy)
+        if dist == 0:
+            self.pos = self.attack_orig
+            return
         move_x = min(dist / self.attack["frames"] * frame, dist) * dx / dist
         move_y = min(dist / self.attack["frames"] * frame, dist) * dy / dist
         self.pos = [self.attack_orig[0] + move_x, self.attack_orig[1] + move_y]
@@ -443,6 +1700,7 @@ class Enemy:
         self.pos[1] += movement[1]
         
     def damage(self, hp):
+        GLOBALS.level.touch_enemies()
         if self.hp > hp:
             self.hp -= hp
             return False
@@ -451,13 +1709,177 @@ class Enemy:
             return True
     
     def __repr__(self):
-        return f"Enemy({self.init_dict})"
+        return f"Enemy({{'image': '{self.image}', 'pos': {[batch_number(c) for c in self.pos]}, 'hp': {self.hp}, 'trigger': {self.trigger}}})"
     
     def __str__(self):
         return self.__repr__()
 
 
 
+# Constructors for the tagged objects in data files
+DATA_CONSTRUCTORS = {
+    "Item": lambda d: Item(d["type"], d.get("count", 1), d.get("slot", "secondary"), d.get("data", {}.copy())),
+    "ItemContainer": lambda d: ItemContainer(d),
+    "Inventory": lambda d: Inventory(d),
+}
+
+# Load a data file of the levels directory, from the compiled level cache if it is up to date
+def load_level_file(lvl_id: str):
+    data = PRELOADER.take(lvl_id)
+    if data is None:
+        data = load_level_data(get__path(f"rpg/data/levels/{lvl_id}.json"), f"__CACHE__/levels/{lvl_id}.lvl", tuple(ACTIONS))
+    return decode(data, DATA_CONSTRUCTORS, COLORS.content)
+
+# Get the (path, size) of all images a level's data uses, for a tiled background the ones around the start
+def get_level_images(lvl_id: str, data):
+    if "background" in data:
+        tile_size = data["background"]["tile_size"]
+        images = [(f"levels/{lvl_id}-background/{x}-{y}.png", None)
+            for x in range(max(0, (data["starting_pos"][0] - WIDTH // 2) // tile_size), (data["starting_pos"][0] + WIDTH // 2) // tile_size + 1)
+            for y in range(max(0, (data["starting_pos"][1] - HEIGHT // 2) // tile_size), (data["starting_pos"][1] + HEIGHT // 2) // tile_size + 1)
+            if x * tile_size < data["background"]["size"][0] and y * tile_size < data["background"]["size"][1]]
+    else:
+        images = [(f"levels/{lvl_id}-background.png", None)]
+    def collect(d):
+        if isinstance(d, list):
+            for i in d: collect(i)
+        elif isinstance(d, dict):
+            if d.get("$type") == "Item":
+                images.append(("items/" + d["type"] + ".png", (96, 96)))
+            if d.get("drops"):
+                images.append((LOOT_IMAGE, None))
+            elif isinstance(d.get("image"), str):
+                images.append((d["image"], None))
+            for i in d.values(): collect(i)
+    collect(data)
+    return images
+
+
+# Class for the LevelPreloader, loading the next level's data and images in a worker thread
+class LevelPreloader:
+    def __init__(self, max_bytes: int = 192 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.lvl_id = None
+        self.data = None
+        self.thread = None
+        self.cancelled = threading.Event()
+        self.done = threading.Event()
+
+    def get_owner(self, lvl_id: str):
+        return f"preload:{lvl_id}"
+
+    # start preloading a level, cancelling any other preload
+    def start(self, lvl_id: str):
+        if lvl_id == self.lvl_id:
+            return
+        self.cancel()
+        if lvl_id == "credits":
+            return
+        self.lvl_id = lvl_id
+        self.cancelled = threading.Event()
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self.run, args=(lvl_id, self.cancelled, self.done), daemon=True)
+        self.thread.start()
+
+    def run(self, lvl_id: str, cancelled: threading.Event, done: threading.Event):
+        try:
+            data = load_level_data(get__path(f"rpg/data/levels/{lvl_id}.json"), f"__CACHE__/levels/{lvl_id}.lvl", tuple(ACTIONS))
+            # only the images decoded by this preload count towards its memory cap, not the ones of the current level
+            loaded = 0
+            for path, size in get_level_images(lvl_id, data):
+                # stop on cancel or when the memory cap is reached, the rest is loaded on demand
+                if cancelled.is_set() or loaded > self.max_bytes:
+                    break
+                resident = ASSETS.is_resident(path, size)
+                surface = ASSETS.get(path, size, self.get_owner(lvl_id))
+                if not resident:
+                    loaded += surface.size[0] * surface.size[1] * 4
+            if not cancelled.is_set():
+                self.data = data
+        except Exception:
+            self.data = None
+        done.set()
+
+    def is_ready(self, lvl_id: str):
+        return lvl_id == self.lvl_id and self.done.is_set() and self.data is not None
+
+    # wait for the preload of a level to finish, or cancel a preload of another level so it doesn't compete with loading this one
+    def wait(self, lvl_id: str):
+        if lvl_id == self.lvl_id:
+            self.done.wait()
+        else:
+            self.cancel()
+
+    # take the preloaded data of a level, if it is ready
+    def take(self, lvl_id: str):
+        if not self.is_ready(lvl_id):
+            return None
+        data = self.data
+        self.data = None
+        return data
+
+    # stop the worker and drop the references of the preloaded images
+    def cancel(self):
+        self.cancelled.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        if self.lvl_id:
+            ASSETS.release(self.get_owner(self.lvl_id))
+        self.lvl_id = None
+        self.data = None
+
+PRELOADER = LevelPreloader()
+
+
+# Class for the SceneManager: the stack of active scenes (e.g. "level" with "pause" on top) and the cached
+# screen objects of every scene, built once and again only when the inputs they depend on changed
+class SceneManager:
+    def __init__(self):
+        self.stack = [].copy()
+        self.builders = {}.copy()
+        self.cache = {}.copy()
+    
+    # register the setup function of a scene, and a function getting the inputs (e.g. translations) its objects depend on
+    def register(self, name: str, setup, get_inputs = lambda: ()):
+        self.builders[name] = (setup, get_inputs)
+    
+    # get the screen objects of a scene, built on first use and when its inputs changed
+    def get(self, name: str):
+        setup, get_inputs = self.builders[name]
+        inputs = get_inputs()
+        cached = self.cache.get(name)
+        if cached is None or cached[0] != inputs:
+            cached = (inputs, setup())
+            self.cache[name] = cached
+        return cached[1]
+    
+    def invalidate(self, name: str = None):
+        if name is None:
+            self.cache.clear()
+        else:
+            self.cache.pop(name, None)
+    
+    def top(self):
+        return self.stack[-1] if self.stack else None
+    
+    # check if a scene is running, also below others (the level while paused)
+    def is_active(self, name: str):
+        return name in self.stack
+    
+    def push(self, name: str):
+        self.stack.append(name)
+    
+    def pop(self):
+        return self.stack.pop() if self.stack else None
+    
+    # replace all scenes with one, or none to quit
+    def switch(self, name: str = None):
+        self.stack.clear()
+        if name is not None:
+            self.stack.append(name)
+
+
 # Setup Screen Objects in Menu
 def setup_menu():
     screen_objects = Enum()
@@ -512,31 +1934,53 @@ def setup_level_select():
 
     return screen_objects
 
+# Start a Level and its Player, without drawing
+def start_level(lvl_id: str, file_dict: dict = None):
+    # images of the new level are referenced by it, the previous level's ones become evictable
+    previous = ASSETS.set_scope(f"level:{lvl_id}")
+    level = Level(lvl_id, {}, file_dict)
+    
+    player = Player(level)
+    if previous != ASSETS.scope:
+        ASSETS.release(previous)
+    
+    GLOBALS.level = level
+    GLOBALS.player = player
+    GLOBALS.level_change = False
+    
+    if not GLOBALS.headless:
+        # prepare the next level while this one is played
+        PRELOADER.cancel()
+        PRELOADER.start(level.next_level)
+        if GLOBALS.replay is None:
+            save_savestate(SAVESTATE)
+    
+    load_dialog(level.start_dialog)
+    
+    return level, player
+
 # Setup (Screen) Objects for a Level
 def setup_level(lvl_id: str):
-    screen_objects = Enum()
-    
-    draw__loading__sign__page("loading.level", 0.5)
+    # a preloaded level is swapped in without a loading page, a running preload is finished instead of loading twice
+    if not PRELOADER.is_ready(lvl_id):
+        draw__loading__sign__page("loading.level", 0.5)
+        PRELOADER.wait(lvl_id)
 
-    level = Level(lvl_id, {})
-    
-    player = Player(level)
+    level, player = start_level(lvl_id)
+
+    return get_level_screen_objects(level), level, player
 
-    screen_objects.set(background = ScreenObject(level.get_background()).set((0, 0), 1))
+# Get the Screen Objects of a Level
+def get_level_screen_objects(level: Level):
+    screen_objects = Enum()
     
-    screen_objects.set(obstacle_hitboxes = [].copy())
-    for o in level.obstacle_hitboxes:
-        screen_objects.obstacle_hitboxes.append(o)
+    screen_objects.set(obstacle_hitboxes = level.obstacle_hitboxes)
         
     screen_objects.set(interactable_objects = [].copy())
     for o in level.interactable_objects:
         screen_objects.interactable_objects.append(o)
-    
-    save_savestate(SAVESTATE)
-    
-    load_dialog(level.start_dialog)
 
-    return screen_objects, level, player
+    return screen_objects
 
 # Setup Screen Objects in Pause Menu
 def setup_pause_menu():
@@ -559,15 +2003,11 @@ def setup_pause_menu():
 
 # Setup Screen Objects in End Credits
 def setup_credits():
-    GLOBALS.in_level = False
-    GLOBALS.in_credits = True
-    
     pages = [].copy()
     
-    with open(get__path("rpg/data/levels/credits.json"), "r") as file:
-        json = eval(file.read())
+    credits = load_level_file("credits")
     
-    for p in json["pages"]:
+    for p in credits["pages"]:
         page = [].copy()
         amount = len(p)+1
         for n, i in enumerate(p):
@@ -576,57 +2016,122 @@ def setup_credits():
     
     return pages
 
-# Save SAVESTATE to File
-def save_savestate(savestate: Enum, filename: str = "savestate.json"):
-    with open(filename, "w") as file:
-        file.write(str(savestate))
-
-# Load SAVESTATE from File
-def load_savestate(default: Enum = None, filename: str = "savestate.json"):
-    try:
-        with open(filename, "r") as file:
-            return Enum().set_with_dict(eval(file.read()))
-    except:
-        return default
+# Get the JSON data of a SAVESTATE
+def savestate_to_data(savestate: Enum):
+    return {k: (i.to_data() if hasattr(i, "to_data") else i) for k, i in savestate.content.items()}
+
+# Get a SAVESTATE from its JSON data
+def savestate_from_data(data: dict):
+    return Enum().set_with_dict(decode(data, DATA_CONSTRUCTORS))
+
+# Class for the SaveWriter, writing savestates atomically in a background thread
+# Saves requested close together are coalesced, only the latest one per file is written
+class SaveWriter:
+    def __init__(self, delay: float = 0.25):
+        self.delay = delay
+        self.pending = {}.copy()
+        self.writing = False
+        self.flushing = False
+        self.condition = threading.Condition()
+        self.thread = None
+        self.logger = logging.getLogger("rpg.save")
+
+    # request a save, the data is taken right away and written later
+    def save(self, savestate: Enum, filename: str):
+        data = savestate_to_data(savestate)
+        with self.condition:
+            self.pending[filename] = data
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.condition.notify_all()
+
+    def run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.pending)
+                # give saves requested right after this one a moment to replace it
+                self.condition.wait_for(lambda: self.flushing, self.delay)
+                pending = self.pending
+                self.pending = {}.copy()
+                self.writing = True
+            # waiting flushes must be woken up however the writing ends
+            try:
+                for filename, data in pending.items():
+                    try:
+                        write_atomic(filename, encode_savestate(data))
+                    except (OSError, DataFormatError) as e:
+                        self.logger.warning(f"could not save {filename}: {e}")
+                    except Exception:
+                        self.logger.exception(f"could not save {filename}")
+            finally:
+                with self.condition:
+                    self.writing = False
+                    self.condition.notify_all()
+
+    # wait until every requested save is written
+    def flush(self):
+        with self.condition:
+            self.flushing = True
+            self.condition.notify_all()
+            self.condition.wait_for(lambda: not self.pending and not self.writing)
+            self.flushing = False
+
+SAVER = SaveWriter()
+
+# Save SAVESTATE to File, in the background
+def save_savestate(savestate: Enum, filename: str = SAVESTATE_FILE):
+    SAVER.save(savestate, filename)
+
+# Load SAVESTATE from File, or from the file of older versions, which is migrated once
+def load_savestate(default: Enum = None, filename: str = SAVESTATE_FILE):
+    SAVER.flush()
+    logger = logging.getLogger("rpg.save")
+    for f in (filename, LEGACY_SAVESTATE_FILE) if filename == SAVESTATE_FILE else (filename,):
+        if not os.path.exists(f):
+            continue
+        try:
+            data = read_savestate(f)
+        except (OSError, DataFormatError) as e:
+            logger.warning(f"could not load the savestate: {e}")
+            return default
+        if f != filename:
+            try:
+                write_atomic(filename, encode_savestate(data))
+                logger.info(f"migrated the savestate {f} to {filename}")
+            except OSError as e:
+                logger.warning(f"could not migrate the savestate {f}: {e}")
+        return savestate_from_data(data)
+    return default
 
 # Activate ActinMenu button
-def activate_action(content: dict):
-    global GLOBALS
-    if content["type"] == "del":
-        if "required" in content:
-            for k, i in content["required"].items():
-                if not SAVESTATE.inventory.content[k] or SAVESTATE.inventory.content[k].type != i:
-                    load_dialog(MSG[content["required_dialog"]])
-                    break
-            else:
-                GLOBALS.level.delete_interactable_object(GLOBALS.active_interactable_id)
-        else:
-            GLOBALS.level.delete_interactable_object(GLOBALS.active_interactable_id)
-    elif content["type"] == "transform":
-        if "required" in content:
-            for k, i in content["required"].items():
-                if not SAVESTATE.inventory.content[k] or SAVESTATE.inventory.content[k].type != i:
-                    load_dialog(MSG[content["required_dialog"]])
-                    break
-            else:
-                GLOBALS.level.interactable_objects[GLOBALS.active_interactable_id] = InteractableObject(content["transform"])
-        else:
-            GLOBALS.level.interactable_objects[GLOBALS.active_interactable_id] = InteractableObject(content["transform"])
-    elif content["type"] == "advance":
-        if "required" in content:
-            for k, i in content["required"].items():
-                if not SAVESTATE.inventory.content[k] or SAVESTATE.inventory.content[k].type != i:
-                    load_dialog(MSG[content["required_dialog"]])
-                    break
-            else:
-                advance_level()
-        else:
-            advance_level()
-    elif content["type"] == "ItemContainer":
-        GLOBALS.open_container = content["constructor"]
-        GLOBALS.in_container = True
+def activate_action(action: Action):
+    if action.is_allowed():
+        action.run()
+    else:
+        load_dialog(MSG[action.required_dialog])
     close_action_menu()
 
+# Open the ItemContainer of an action
+def open_container(action: Action):
+    GLOBALS.open_container = action.target
+    GLOBALS.in_container = True
+
+# Actions of InteractableObjects by type: (run, prepare), see register_action
+ACTIONS = {}.copy()
+
+# Register an action type for the interactable objects of levels:
+# run(action) when the player activates it, prepare(content) once at level load with the action's level data,
+# its result is action.target
+def register_action(t: str, run, prepare = None):
+    ACTIONS[t] = (run, prepare)
+
+register_action("del", lambda action: GLOBALS.level.delete_interactable_object(GLOBALS.active_interactable_id))
+register_action("transform", lambda action: GLOBALS.level.replace_interactable_object(GLOBALS.active_interactable_id, action.target),
+    lambda content: InteractableObject(content["transform"]))
+register_action("advance", lambda action: advance_level())
+register_action("ItemContainer", open_container, lambda content: content["constructor"])
+
 # Close the current ActionMenu
 def close_action_menu():
     GLOBALS.in_action_menu = False
@@ -634,41 +2139,189 @@ def close_action_menu():
     GLOBALS.active_interactable_id = None
     GLOBALS.update_view = True
 
-# Close the current Container
+# Close the current Container, an emptied loot container is removed from the ground
 def close_container():
+    container = GLOBALS.open_container
+    if container is not None and container.loot is not None and GLOBALS.level is not None and not any(container.items):
+        if container.loot in GLOBALS.level.interactable_objects:
+            GLOBALS.level.delete_interactable_object(GLOBALS.level.interactable_objects.index(container.loot))
+        container.loot = None
     GLOBALS.in_container = False
     GLOBALS.open_container = None
     GLOBALS.update_view = True
 
-# Draw the player's Inventory
-def draw_inventory():
-    for n, i in {0: "primary", 1: "secondary", 2: "consumable"}.items():
-        o = ScreenObject(Surface((96, 96), Color(0, 0, 0, 127))).set((68, 120 * n + 20), 6, (True, False))
-        o.blit(Surface((90, 90), COLORS.content[i]), (3, 3))
+# Set the player's health points
+def set_hp(hp: int):
+    SAVESTATE.hp = hp
+
+# Class for an element of the HUD (inventory slots, player HP or enemy HP), composited once per change
+# into a surface only as big as its content
+class HudElement:
+    def __init__(self, get_version, layout):
+        self.get_version = get_version
+        self.layout = layout
+        self.version = None
+        self.rect = (0, 0, 0, 0)
+        self.screen_object = None
+
+    # rebuild the surface if the element changed, layout returns the surfaces to blit at their screen positions
+    def update(self):
+        version = self.get_version()
+        if version == self.version:
+            return
+        self.version = version
+        blits = self.layout()
+        if not blits:
+            self.rect = (0, 0, 0, 0)
+            self.screen_object = None
+            return
+
+        rect = (blits[0][1][0], blits[0][1][1], blits[0][0].size[0], blits[0][0].size[1])
+        for s, pos in blits[1:]:
+            rect = rect_union(rect, (pos[0], pos[1], s.size[0], s.size[1]))
+        # never bigger than the screen
+        x, y = max(rect[0], 0), max(rect[1], 0)
+        rect = (x, y, max(1, min(rect[0] + rect[2], WIDTH) - x), max(1, min(rect[1] + rect[3], HEIGHT) - y))
+
+        surface = Surface(rect[2:], Color(0, 0, 0, 0))
+        for s, pos in blits:
+            surface.blit(s, (pos[0] - rect[0], pos[1] - rect[1]))
+        self.rect = rect
+        self.screen_object = ScreenObject(surface).set(rect[:2], 6)
+
+# Get the blits of the inventory slots
+def layout_hud_inventory():
+    blits = [].copy()
+    for n, i in enumerate(INVENTORY_SLOTS):
+        blits.append((Surface((96, 96), COLORS.shadow), (20, 120 * n + 20)))
+        blits.append((Surface((90, 90), COLORS.content[i]), (23, 120 * n + 23)))
         if SAVESTATE.inventory.content[i]:
-            o.blit(SAVESTATE.inventory.content[i].get_surface(), (0, 0))
-        draw(o)
-        t = ScreenObject(Text(MSG["item_slot."+i], COLORS.light_grey, Color(0, 0, 0, 127), 1)).set((68, 120 * n + 100 + 20), 6, (True, False))
-        draw(t)
-
-# Draw the player's health points
-def draw_hp():
-    if SAVESTATE.hp > 30:
-        c = COLORS.light_blue
-    else:
-        c = COLORS.light_red
-    so = ScreenObject(Text(f"HP: {SAVESTATE.hp} / 100", c, Color(0, 0, 0, 127), 2)).set((WIDTH // 2, 16), 6, (True, False))
-    draw(so)
+            blits.append((SAVESTATE.inventory.content[i].get_surface(), (20, 120 * n + 20)))
+        label = cached_text(MSG["item_slot."+i], COLORS.light_grey, COLORS.shadow, 1)
+        blits.append((label, (68 - label.size[0] // 2, 120 * n + 100 + 20)))
+    return blits
+
+# Get the blit of the player's health points
+def layout_hud_hp():
+    c = COLORS.light_blue if SAVESTATE.hp > 30 else COLORS.light_red
+    text = cached_text(f"HP: {SAVESTATE.hp} / 100", c, COLORS.shadow, 2)
+    return [(text, (WIDTH // 2 - text.size[0] // 2, 16))]
+
+# Get the blits of the triggered enemies' health points, stopping at the bottom of the screen
+def layout_hud_enemy_hp():
+    blits = [].copy()
     for n, e in enumerate(GLOBALS.level.enemies):
+        y = 16 + 34 * (n+1)
+        if y >= HEIGHT:
+            break
         if e.triggered:
-            so = ScreenObject(Text(f"Enemy HP: {e.hp}", COLORS.red, Color(0, 0, 0, 127), 2)).set((WIDTH // 2, 16 + 34 * (n+1)), 6, (True, False))
-            draw(so)
+            text = cached_text(f"Enemy HP: {e.hp}", COLORS.red, COLORS.shadow, 2)
+            blits.append((text, (WIDTH // 2 - text.size[0] // 2, y)))
+    return blits
+
+# Class for the HUD layer, split into elements so a change only redraws the screen region of its element
+class HudLayer:
+    def __init__(self):
+        self.elements = {
+            "inventory": HudElement(lambda: SAVESTATE.inventory.version, layout_hud_inventory),
+            # keyed on the HP itself, so a replaced SAVESTATE (restart, continue, replay) is shown as well
+            "hp": HudElement(lambda: SAVESTATE.hp, layout_hud_hp),
+            "enemy_hp": HudElement(lambda: GLOBALS.level.enemy_version, layout_hud_enemy_hp),
+        }
+
+    # get the level layers of the elements, as (key, screen rect, state token, draw function)
+    def get_layers(self):
+        layers = [].copy()
+        for name, element in self.elements.items():
+            element.update()
+            if element.screen_object:
+                layers.append((("hud", name), element.rect, element.version, lambda element=element: draw(element.screen_object)))
+        return layers
+
+HUD = HudLayer()
+
+# Draw the HUD layer
+def draw_hud():
+    for k, r, t, f in HUD.get_layers():
+        f()
+
+# Class for the DialogRenderer, revealing the glyphs of a dialog line on a kept panel
+class DialogRenderer:
+    def __init__(self, font_size: float = 2, line_height: int = 32):
+        self.font_size = font_size
+        self.line_height = line_height
+        self.size = (WIDTH - 16, HEIGHT // 4 - 16)
+        self.max_width = self.size[0] - 16
+        self.line = None
+        self.key = None
+        self.glyphs = [].copy()
+        self.revealed = 0
+        self.screen_object = None
+
+    # wrap a line on word boundaries into rows of (start, end) character indices
+    def wrap(self, line: str):
+        rows = [].copy()
+        start = 0
+        while start < len(line):
+            end = start
+            width = 0
+            while end < len(line):
+                word_end = line.find(" ", end + 1)
+                if word_end < 0: word_end = len(line)
+                word_width = text_width(line[end:word_end], self.font_size)
+                if width + word_width > self.max_width and end > start:
+                    break
+                width += word_width
+                end = word_end
+            # a single word wider than the panel is split
+            while text_width(line[start:end], self.font_size) > self.max_width and end - start > 1:
+                end -= 1
+            rows.append((start, end))
+            start = end
+            while start < len(line) and line[start] == " ":
+                start += 1
+        return rows
+
+    # lay out a dialog line once, the glyph positions are kept for the typewriter ticks
+    def layout(self, line: str, key = None):
+        self.line = line
+        self.key = key
+        self.glyphs = [None] * len(line)
+        for n, (start, end) in enumerate(self.wrap(line)):
+            x = self.size[0] // 2 - int(text_width(line[start:end], self.font_size)) // 2
+            for i in range(start, end):
+                if line[i] != " ":
+                    self.glyphs[i] = (line[i], (x, 16 + self.line_height * n))
+                x += text_width(line[i], self.font_size)
+        self.screen_object = ScreenObject(Surface(self.size, COLORS.shadow)).set((8, HEIGHT // 4 * 3 + 8), 6)
+        self.revealed = 0
+
+    # blit only the glyphs revealed since the last update
+    def update(self, frame: int):
+        frame = min(frame, len(self.glyphs))
+        if frame < self.revealed:
+            self.layout(self.line, self.key)
+        for glyph in self.glyphs[self.revealed:frame]:
+            if glyph:
+                self.screen_object.blit(cached_text(glyph[0], COLORS.light_grey, font_size=self.font_size), glyph[1])
+        self.revealed = max(self.revealed, frame)
+
+    def get_screen_object(self):
+        return self.screen_object
+
+DIALOG_RENDERER = DialogRenderer()
+
+# Lay out the current dialog line for the DIALOG_RENDERER
+def layout_dialog():
+    if GLOBALS.dialog_id >= 0 and not GLOBALS.headless:
+        DIALOG_RENDERER.layout(GLOBALS.dialog[GLOBALS.dialog_id], (id(GLOBALS.dialog), GLOBALS.dialog_id))
 
 # Load a new dialog
 def load_dialog(dialog_list: list = [].copy()):
     GLOBALS.dialog = dialog_list.copy()
     GLOBALS.dialog_id = 0 if dialog_list else -1
     GLOBALS.dialog_animation_frame = 0 if dialog_list else -1
+    layout_dialog()
 
 # Advance in the current dialog
 def advance_dialog(amount: int = 1):
@@ -678,71 +2331,338 @@ def advance_dialog(amount: int = 1):
         GLOBALS.dialog_id = -1
         GLOBALS.dialog = [].copy()
         GLOBALS.dialog_animation_frame = -1
+    layout_dialog()
 
 # Draw the current dialog
 def draw_dialog():
     if GLOBALS.dialog_id >= 0:
-        so = ScreenObject(Surface((WIDTH - 16, HEIGHT // 4 - 16), Color(0, 0, 0, 127))).set((8, HEIGHT // 4 * 3 + 8), 6)
-        length = len(GLOBALS.dialog[GLOBALS.dialog_id][:GLOBALS.dialog_animation_frame])
-        max_chars = 55
-        for n in range(length // max_chars + 1):
-            if (n+1) * max_chars <= length: t = GLOBALS.dialog[GLOBALS.dialog_id][n*max_chars:(n+1)*max_chars]
-            else: t = GLOBALS.dialog[GLOBALS.dialog_id][n*max_chars:length]
-            so.blit(Text(t, COLORS.light_grey, font_size=2), (WIDTH // 2 - 8, 16+32*n), (True, False))
-        draw(so)
-
-# Draw debugging hitboxes
-def draw_hitboxes(screen_objects):
+        key = (id(GLOBALS.dialog), GLOBALS.dialog_id)
+        if DIALOG_RENDERER.key != key:
+            DIALOG_RENDERER.layout(GLOBALS.dialog[GLOBALS.dialog_id], key)
+        DIALOG_RENDERER.update(GLOBALS.dialog_animation_frame)
+        draw(DIALOG_RENDERER.get_screen_object())
+
+# Phases of an in-level frame, in order, and the profiler phase of the drawn layers
+PROFILE_PHASES = ("wait", "events", "triggers", "enemies", "player", "layers", "background", "objects", "hud", "dialog", "present")
+LAYER_PHASES = {"hud": "hud", "dialog": "dialog"}
+
+# Class for the FrameProfiler, timing the phases of each frame into a ring buffer
+# Disabled, every mark is a single check; F3 (or --profile / RPG_PROFILE=1) toggles it and its overlay
+class FrameProfiler:
+    def __init__(self, size: int = 600, log_interval: float = 10.0, overlay_interval: float = 0.5, budget: float = 1 / TICK_RATE):
+        self.size = size
+        self.log_interval = log_interval
+        self.overlay_interval = overlay_interval
+        self.budget = budget
+        self.enabled = False
+        self.logger = logging.getLogger("rpg.profiler")
+        self.reset()
+    
+    def reset(self):
+        self.samples = {p: [0.0] * self.size for p in PROFILE_PHASES}
+        self.frames = [0.0] * self.size
+        self.index = 0
+        self.count = 0
+        self.current = dict.fromkeys(PROFILE_PHASES, 0.0)
+        self.last_time = time.perf_counter()
+        self.last_log = self.last_time
+        self.last_overlay = self.last_time
+        self.version = next_version()
+        self.screen_object = None
+    
+    def set_enabled(self, enabled: bool):
+        if enabled and not self.enabled:
+            self.reset()
+        self.enabled = enabled
+    
+    def start_frame(self):
+        if not self.enabled:
+            return
+        self.current = dict.fromkeys(PROFILE_PHASES, 0.0)
+        self.last_time = time.perf_counter()
+    
+    # count the time since the last mark to a phase
+    def mark(self, phase: str):
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        self.current[phase] += now - self.last_time
+        self.last_time = now
+    
+    def end_frame(self):
+        if not self.enabled:
+            return
+        for p in PROFILE_PHASES:
+            self.samples[p][self.index] = self.current[p]
+        self.frames[self.index] = sum(self.current.values()) - self.current["wait"]
+        self.index = (self.index + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+        
+        now = time.perf_counter()
+        if now - self.last_overlay >= self.overlay_interval:
+            self.last_overlay = now
+            self.version = next_version()
+            GLOBALS.update_view = True
+        if now - self.last_log >= self.log_interval:
+            self.last_log = now
+            self.logger.info(self.get_summary())
+    
+    # get the 50th, 95th and 99th percentile and the maximum of a ring buffer, in ms
+    def get_percentiles(self, values: list):
+        values = sorted(values[:self.count])
+        if not values:
+            return (0.0, 0.0, 0.0, 0.0)
+        return tuple(values[min(len(values) - 1, int(len(values) * q))] * 1000 for q in (0.5, 0.95, 0.99)) + (values[-1] * 1000,)
+    
+    # count the frames per frame time bucket (ms)
+    def get_histogram(self, buckets: tuple = (4, 8, 16, 33, 66)):
+        counts = [0] * (len(buckets) + 1)
+        for t in self.frames[:self.count]:
+            n = 0
+            while n < len(buckets) and t * 1000 >= buckets[n]:
+                n += 1
+            counts[n] += 1
+        labels = [f"<{b}" for b in buckets] + [f">={buckets[-1]}"]
+        return dict(zip(labels, counts))
+    
+    def get_summary(self):
+        frame = self.get_percentiles(self.frames)
+        over = sum(1 for t in self.frames[:self.count] if t > self.budget)
+        phases = ", ".join(f"{p} %.2f/%.2f/%.2f/%.2f" % self.get_percentiles(self.samples[p]) for p in PROFILE_PHASES)
+        return (f"frames {self.count}: p50/p95/p99/max %.2f/%.2f/%.2f/%.2f ms, {over} over budget, histogram {self.get_histogram()}; " % frame
+            + f"phases (ms p50/p95/p99/max): {phases}")
+    
+    def get_rect(self):
+        return (WIDTH - 328, 8, 320, 24 + 18 * (len(PROFILE_PHASES) + 1))
+    
+    def update_surface(self):
+        rect = self.get_rect()
+        surface = Surface(rect[2:], COLORS.shadow)
+        lines = [("frame", self.get_percentiles(self.frames))] + [(p, self.get_percentiles(self.samples[p])) for p in PROFILE_PHASES]
+        surface.blit(Text("ms      p50    p95    p99    max", COLORS.light_grey, font_size = 1), (8, 4))
+        for n, (name, values) in enumerate(lines):
+            c = COLORS.light_red if name == "frame" and values[1] > self.budget * 1000 else COLORS.light_grey
+            surface.blit(Text(f"{name:<10} " + " ".join(f"{v:6.2f}" for v in values), c, font_size = 1), (8, 22 + 18 * n))
+        self.screen_object = ScreenObject(surface).set(rect[:2], 7)
+        self.screen_version = self.version
+    
+    def get_screen_object(self):
+        if self.screen_object is None or self.screen_version != self.version:
+            self.update_surface()
+        return self.screen_object
+
+PROFILER = FrameProfiler()
+
+# Check if two rectangles (x, y, w, h) overlap
+def rect_intersects(a, b):
+    return a[0] < b[0] + b[2] and b[0] < a[0] + a[2] and a[1] < b[1] + b[3] and b[1] < a[1] + a[3]
+
+# Check if rectangle a contains rectangle b
+def rect_contains(a, b):
+    return a[0] <= b[0] and a[1] <= b[1] and b[0] + b[2] <= a[0] + a[2] and b[1] + b[3] <= a[1] + a[3]
+
+# Get the smallest rectangle containing a and b
+def rect_union(a, b):
+    x = min(a[0], b[0])
+    y = min(a[1], b[1])
+    return (x, y, max(a[0] + a[2], b[0] + b[2]) - x, max(a[1] + a[3], b[1] + b[3]) - y)
+
+# Get the layers of the level view in drawing order, as (key, screen rect, state token, draw function)
+def get_level_layers(screen_objects):
+    layers = [].copy()
+    background_pos = GLOBALS.player.get_background_pos()
+    
     if GLOBALS.dev:
+        # the obstacle hitboxes are views created on demand, keyed by their index
         for o in screen_objects.obstacle_hitboxes:
-            draw(o.get_hitbox_screen_object(GLOBALS.player.get_background_pos()))
+            so = o.get_hitbox_screen_object(background_pos)
+            layers.append((("obstacle", o.index), (so.pos[0], so.pos[1], o.size[0], o.size[1]), None, lambda so=so: draw(so)))
         for o in screen_objects.interactable_objects:
-            draw(o.get_hitbox_screen_object(GLOBALS.player.get_background_pos()))
+            so = o.get_hitbox_screen_object(background_pos)
+            layers.append((("hitbox", id(o)), (so.pos[0], so.pos[1], o.size[0], o.size[1]), None, lambda so=so: draw(so)))
+    
+    for i in GLOBALS.level.interactable_objects:
+        rect = (i.pos[0] + background_pos[0], i.pos[1] + background_pos[1], i.size[0], i.size[1])
+        layers.append((("interactable", id(i)), rect, id(i.get_surface()),
+            lambda i=i, rect=rect: draw(i.get_screen_object().set_pos(rect[:2]))))
+    
+    # only the enemies near the viewport, with a margin for their movement since the last tick
+    margin = GLOBALS.level.enemy_hash.cell_size
+    viewport = (-background_pos[0] - margin, -background_pos[1] - margin, WIDTH + margin * 2, HEIGHT + margin * 2)
+    for e in sorted(GLOBALS.level.enemy_hash.query_rect(viewport), key=lambda e: e.index):
+        if e.triggered:
+            pos = e.get_render_pos()
+            rect = (int(pos[0] + background_pos[0]), int(pos[1] + background_pos[1]), e.surface.size[0], e.surface.size[1])
+            layers.append((("enemy", id(e)), rect, id(e.surface),
+                lambda e=e, rect=rect: draw(e.get_screen_object().set_pos(rect[:2]))))
+    
+    player_size = GLOBALS.player.surface.size
+    screen_pos = GLOBALS.player.get_screen_pos()
+    layers.append((("player",), (screen_pos[0] - player_size[0] // 2, screen_pos[1] - player_size[1] // 2, player_size[0], player_size[1]),
+        id(GLOBALS.player.surface), lambda: draw(GLOBALS.player.get_screen_object())))
+    
+    layers.extend(HUD.get_layers())
+    
+    if GLOBALS.dialog_id >= 0:
+        layers.append((("dialog",), (8, HEIGHT // 4 * 3 + 8, WIDTH - 16, HEIGHT // 4 - 16),
+            (id(GLOBALS.dialog), GLOBALS.dialog_id, GLOBALS.dialog_animation_frame), draw_dialog))
+    
+    for menu in (GLOBALS.action_menu if GLOBALS.in_action_menu else None, GLOBALS.open_container if GLOBALS.in_container else None):
+        if menu:
+            so = menu.get_screen_object()
+            layers.append((("menu", id(so)), (so.pos[0], so.pos[1], so.size[0], so.size[1]), None, lambda so=so: draw(so)))
+            for b in menu.buttons:
+                layers.append((("button", id(b)), (b.pos[0], b.pos[1], b.size[0], b.size[1]), b.get_mouse_collision(), lambda b=b: draw(b)))
+    
+    if SCENES.top() == "pause":
+        pause_menu = SCENES.get("pause")
+        layers.append((("pause",), (0, 0, WIDTH, HEIGHT), None, lambda: (
+            draw(pause_menu.overlay), draw(pause_menu.title), draw(pause_menu.cont), draw(pause_menu.quit))))
+    
+    if PROFILER.enabled:
+        layers.append((("profiler",), PROFILER.get_rect(), PROFILER.version, lambda: draw(PROFILER.get_screen_object())))
+    
+    if GLOBALS.game_over:
+        layers.append((("game_over",), (0, 0, WIDTH, HEIGHT), None, lambda: (
+            draw(ScreenObject(Surface((WIDTH, HEIGHT), Color(0, 0, 0, 127))).set((0, 0), 7)),
+            draw(ScreenObject(cached_text(MSG["game_over"], COLORS.red, font_size=3)).set((WIDTH // 2, HEIGHT // 2), 7, (True, True))))))
+    
+    return layers
+
+
+# Class for the Renderer of the level view, redrawing only the changed screen regions in dirty rect mode
+class LevelRenderer:
+    def __init__(self, dirty_rects: bool = True):
+        self.dirty_rects = dirty_rects
+        self.last_layers = {}.copy()
+        self.background_pos = None
+        self.full_redraw = True
+        self.regions = [].copy()
+    
+    # force a full redraw on the next render
+    def invalidate(self):
+        self.full_redraw = True
+    
+    # draw the level view, returns False if nothing changed
+    def render(self, screen_objects):
+        layers = get_level_layers(screen_objects)
+        current = {k: (r, t) for k, r, t, f in layers}
+        background_pos = GLOBALS.player.get_background_pos()
+        
+        # the camera scrolled or an overlay covers the screen, redraw everything
+        if not self.dirty_rects or self.full_redraw or background_pos != self.background_pos or SCENES.top() == "pause" or GLOBALS.game_over:
+            PROFILER.mark("layers")
+            draw__clean()
+            GLOBALS.level.get_background().draw(background_pos)
+            PROFILER.mark("background")
+            for k, r, t, f in layers:
+                f()
+                PROFILER.mark(LAYER_PHASES.get(k[0], "objects"))
+            self.regions = [(0, 0, WIDTH, HEIGHT)]
+        else:
+            self.regions = self.get_dirty_regions(current, [r for k, r, t, f in layers])
+            PROFILER.mark("layers")
+            if not self.regions:
+                self.last_layers = current
+                return False
+            for r in self.regions:
+                GLOBALS.level.get_background().draw_region(background_pos, r)
+            PROFILER.mark("background")
+            for k, r, t, f in layers:
+                if any(rect_intersects(r, d) for d in self.regions):
+                    f()
+                    PROFILER.mark(LAYER_PHASES.get(k[0], "objects"))
+        
+        # dia_graphics copies its screen to the window as a whole, there is no partial present
+        draw__window()
+        PROFILER.mark("present")
+        self.last_layers = current
+        self.background_pos = background_pos
+        self.full_redraw = False
+        return True
+    
+    # collect the old and new rectangles of changed layers and grow them until every touched layer is inside one region
+    def get_dirty_regions(self, current, layer_rects):
+        dirty = [].copy()
+        for k, (r, t) in current.items():
+            old = self.last_layers.get(k)
+            if old != (r, t):
+                dirty.append(r)
+                if old: dirty.append(old[0])
+        for k, (r, t) in self.last_layers.items():
+            if k not in current:
+                dirty.append(r)
+        
+        regions = [].copy()
+        for d in dirty:
+            if d[2] > 0 and d[3] > 0:
+                regions.append(d)
+        changed = True
+        while changed:
+            changed = False
+            for n, d in enumerate(regions):
+                for l in layer_rects:
+                    if rect_intersects(d, l) and not rect_contains(d, l):
+                        d = rect_union(d, l)
+                        changed = True
+                regions[n] = d
+            merged = [].copy()
+            for d in regions:
+                for m, o in enumerate(merged):
+                    if rect_intersects(d, o):
+                        merged[m] = rect_union(d, o)
+                        changed = True
+                        break
+                else:
+                    merged.append(d)
+            regions = merged
+        return regions
+
 
 # Use item in CONSUMABLE slot
 def use_consumable():
     if SAVESTATE.inventory.consumable:
         if "healing" in SAVESTATE.inventory.consumable.data:
             GLOBALS.player.heal(SAVESTATE.inventory.consumable.data["healing"])
-            if SAVESTATE.inventory.consumable.count > 1:
-                SAVESTATE.inventory.consumable.count -= 1
-                SAVESTATE.inventory.consumable.update_surface()
-            else: SAVESTATE.inventory.set(consumable = None)
+            SAVESTATE.inventory.remove_item(SAVESTATE.inventory.consumable.type)
             GLOBALS.update_view = True
 
 # Use item in PRIMARY slot (attack)
 def use_primary():
     if SAVESTATE.inventory.primary:
         if "damage" in SAVESTATE.inventory.primary.data:
-            for e in GLOBALS.level.enemies:
-                player_size = GLOBALS.player.surface.size
-                start = (GLOBALS.player.pos[0] + player_size[0] // 2, GLOBALS.player.pos[1] + player_size[1] // 2)
-                target = (e.pos[0] + e.surface.size[0] // 2, e.pos[1] + e.surface.size[1] // 2)
-                dx = target[0] - start[0]
-                dy = target[1] - start[1]
-                is_hit = False
-                if GLOBALS.player.facing == "front":
-                    if -(player_size[0] * 2) < dx < (player_size[0] * 2):
-                        if 0 < dy < player_size[1] * 2:
-                            is_hit = True
-                elif GLOBALS.player.facing == "back":
-                    if -(player_size[0] * 2) < dx < (player_size[0] * 2):
-                        if 0 > dy > -(player_size[1] * 2):
-                            is_hit = True
-                elif GLOBALS.player.facing == "right":
-                    if -(player_size[1] * 2) < dy < (player_size[1] * 2):
-                        if 0 < dy < player_size[1] * 2:
-                            is_hit = True
-                elif GLOBALS.player.facing == "left":
-                    if -(player_size[1] * 2) < dy < (player_size[1] * 2):
-                        if 0 > dy > -(player_size[1] * 2):
-                            is_hit = True
-                if is_hit:
-                    if e.damage(SAVESTATE.inventory.primary.data["damage"]):
-                        for i in e.drops:
-                            GLOBALS.player.collect_item(i)
-                        GLOBALS.level.enemies.remove(e)
+            player_size = GLOBALS.player.surface.size
+            start = (GLOBALS.player.pos[0] + player_size[0] // 2, GLOBALS.player.pos[1] + player_size[1] // 2)
+            if GLOBALS.level.enemies:
                 GLOBALS.update_view = True
+            # hit the enemies in front of the player within twice its size, in level order
+            hits = GLOBALS.level.enemy_hash.query_arc(start, GLOBALS.player.facing, (player_size[0] * 2, player_size[1] * 2))
+            loot = [].copy()
+            loot_pos = None
+            for e in sorted(hits, key=lambda e: e.index):
+                if e.damage(SAVESTATE.inventory.primary.data["damage"]):
+                    loot += GLOBALS.player.collect_items(e.drops)
+                    loot_pos = loot_pos or tuple(e.pos)
+                    GLOBALS.level.remove_enemy(e)
+            # drops that do not fit into the inventory stay on the ground in a container, instead of replacing items
+            if loot:
+                GLOBALS.open_container = drop_loot(loot, loot_pos)
+                GLOBALS.in_container = True
+
+# Put items on the ground at pos in a loot container the player can open like a chest, returns the container
+# it is placed further in the player's facing direction if it would block the player
+def drop_loot(items: list, pos: tuple):
+    container = ItemContainer({"items": items})
+    loot = InteractableObject({"type": "loot", "pos": [int(pos[0]), int(pos[1])], "image": LOOT_IMAGE, "description": "loot.description",
+        "actions": [{"type": "ItemContainer", "name": "level.interact.show_contents", "constructor": container}]})
+    player = GLOBALS.player
+    feet = Position((player.pos[0], player.pos[1] + player.surface.size[1]), player.collision_size)
+    step = FACING_DIRECTIONS[player.facing]
+    while loot.get_collision(feet):
+        loot.pos = [loot.pos[0] + step[0] * 16, loot.pos[1] + step[1] * 16]
+    GLOBALS.level.add_interactable_object(loot)
+    container.loot = loot
+    return container
 
 # Advance to the next level
 def advance_level():
@@ -757,16 +2677,346 @@ def game_over():
     GLOBALS.game_over = True
 
 
+# Get the render position between the previous and the current tick position
+def interpolate(prev_pos: tuple, pos: tuple):
+    alpha = GLOBALS.render_alpha
+    if alpha >= 1 or prev_pos == pos:
+        return (round(pos[0]), round(pos[1]))
+    return (round(prev_pos[0] + (pos[0] - prev_pos[0]) * alpha), round(prev_pos[1] + (pos[1] - prev_pos[1]) * alpha))
+
+# Remember the positions before a tick, to interpolate between them while rendering
+def snapshot_positions():
+    GLOBALS.player.prev_pos = tuple(GLOBALS.player.pos)
+    GLOBALS.level.enemy_batch.snapshot()
+
+# Check if anything is drawn between two tick positions
+def is_interpolating():
+    if GLOBALS.render_alpha >= 1:
+        return False
+    if GLOBALS.player.prev_pos != tuple(GLOBALS.player.pos):
+        return True
+    return GLOBALS.level.enemy_batch.is_moving()
+
+
+# Class for a fixed Timestep: real time is accumulated and consumed in ticks of equal length
+class FixedTimestep:
+    def __init__(self, tick_rate: int = TICK_RATE, max_ticks: int = MAX_TICKS_PER_FRAME):
+        self.tick_time = 1 / tick_rate
+        self.max_ticks = max_ticks
+        self.reset()
+    
+    # restart after a pause in real time (loading), without catching up
+    def reset(self):
+        self.last_time = time.perf_counter()
+        self.accumulator = 0.0
+    
+    # get the number of ticks due since the last call
+    def advance(self):
+        now = time.perf_counter()
+        self.accumulator += now - self.last_time
+        self.last_time = now
+        ticks = int(self.accumulator // self.tick_time)
+        if ticks > self.max_ticks:
+            # too slow to catch up, drop the backlog instead of spiraling
+            ticks = self.max_ticks
+            self.accumulator = 0.0
+        else:
+            self.accumulator -= ticks * self.tick_time
+        return ticks
+    
+    # get the time (s) until the next tick is due
+    def get_wait(self):
+        return max(0.0, self.tick_time - self.accumulator - (time.perf_counter() - self.last_time))
+    
+    # get the fraction of the next tick that already passed
+    def get_alpha(self):
+        return min(self.accumulator / self.tick_time, 1.0)
+
+
+# Block until an event arrives or the timeout (ms) passed, then get all pending events
+def wait_events(timeout: int = IDLE_TIMEOUT):
+    event = pg.event.wait(timeout)
+    if event.type == pg.NOEVENT:
+        return [].copy()
+    return [event] + pg.event.get()
+
+
+# Keys handled by the level simulation, by their name in a TickInput
+KEY_NAMES = {pg.K_ESCAPE: "escape", pg.K_SPACE: "space", pg.K_q: "q", pg.K_e: "e"}
+MOVEMENT_KEYS = {"w": (0, -1), "s": (0, 1), "a": (-1, 0), "d": (1, 0)}
+
+# Class for the input of one simulation tick: held movement keys, pressed keys, mouse clicks and quitting
+class TickInput:
+    def __init__(self, held: tuple = (), keys: tuple = (), clicks: tuple = (), quit: bool = False):
+        self.held = tuple(held)
+        self.keys = tuple(keys)
+        self.clicks = tuple(tuple(c) for c in clicks)
+        self.quit = quit
+
+    def __repr__(self):
+        return f"TickInput({self.held}, {self.keys}, {self.clicks}, {self.quit})"
+
+    def __str__(self):
+        return self.__repr__()
+
+# Read the TickInput of this frame from the keyboard state and the events,
+# a movement key pressed and already released again in this frame counts as held
+def read_tick_input(events: list):
+    pressed = pg.key.get_pressed()
+    tapped = [event.key for event in events if event.type == pg.KEYDOWN]
+    held = [k for k in MOVEMENT_KEYS if pressed[getattr(pg, "K_" + k)] or getattr(pg, "K_" + k) in tapped]
+    keys = [].copy()
+    clicks = [].copy()
+    quit = False
+    for event in events:
+        if event.type == pg.QUIT:
+            quit = True
+        if event.type == pg.KEYDOWN and event.key in KEY_NAMES:
+            keys.append(KEY_NAMES[event.key])
+        if event.type == pg.MOUSEBUTTONDOWN:
+            clicks.append(event.pos)
+    return TickInput(held, keys, clicks, quit)
+
+# Check if a screen position is on a Button
+def button_contains(button, pos: tuple):
+    return button.pos[0] <= pos[0] < button.pos[0] + button.size[0] and button.pos[1] <= pos[1] < button.pos[1] + button.size[1]
+
+# Handle a mouse click in a level
+def click_level(pos: tuple):
+    # if in the pause menu
+    if SCENES.top() == "pause":
+        pause_menu = SCENES.get("pause")
+        if button_contains(pause_menu.cont, pos):
+            SCENES.pop()
+        elif button_contains(pause_menu.quit, pos):
+            GLOBALS.level = None
+            SCENES.switch("menu")
+            
+    # if in an ActionMenu view
+    elif GLOBALS.in_action_menu:
+        for b in GLOBALS.action_menu.buttons:
+            if button_contains(b, pos):
+                activate_action(b.content)
+                break
+                
+    # if in an ItemContainer view
+    elif GLOBALS.in_container:
+        container = GLOBALS.open_container
+        for b in container.buttons:
+            if button_contains(b, pos):
+                if b.item is None:
+                    container.turn_page(b.step)
+                elif container.remove_item(b.item):
+                    container.add_items(GLOBALS.player.collect_items([b.item], replace = True))
+                break
+            
+    GLOBALS.update_view = True
+
+# Handle a key press in a level
+def press_level_key(key: str):
+    if key == "escape":
+        # the pause scene's objects are cached, pausing and resuming only pushes and pops it
+        if SCENES.top() == "pause":
+            SCENES.pop()
+        else:
+            SCENES.push("pause")
+        
+    if SCENES.top() != "pause":
+        if GLOBALS.dialog_id >= 0:
+            if key == "space":
+                advance_dialog()
+                
+        if key == "q":
+            use_consumable()
+            
+        if key == "e":
+            use_primary()
+            
+    GLOBALS.update_view = True
+
+# Advance the level by one tick from explicit input, without drawing or waiting
+def update_level(inputs: TickInput):
+    snapshot_positions()
+    
+    if inputs.quit:
+        SCENES.switch()
+        GLOBALS.main_loop = False
+        return
+    
+    if SCENES.top() != "pause":
+        # advance the dialog text animation
+        if GLOBALS.dialog_animation_frame >= 0:
+            if GLOBALS.dialog_animation_frame < len(GLOBALS.dialog[GLOBALS.dialog_id]):
+                GLOBALS.dialog_animation_frame += 1
+                GLOBALS.update_view = True
+        
+        # trigger enemies whose zone the player entered
+        if GLOBALS.level.trigger_index.update(GLOBALS.player.pos):
+            GLOBALS.level.touch_enemies()
+            GLOBALS.update_view = True
+        PROFILER.mark("triggers")
+        
+        # move enemies toward the player
+        if GLOBALS.level.enemy_batch.update():
+            GLOBALS.update_view = True
+        PROFILER.mark("enemies")
+    
+        # held buttons for movement
+        for k in inputs.held:
+            GLOBALS.player.move((MOVEMENT_KEYS[k][0] * GLOBALS.level.movement_speed, MOVEMENT_KEYS[k][1] * GLOBALS.level.movement_speed))
+            GLOBALS.update_view = True
+            if not SCENES.is_active("level") or GLOBALS.level_change:
+                return
+    
+    for pos in inputs.clicks:
+        click_level(pos)
+        if not SCENES.is_active("level") or GLOBALS.level_change:
+            return
+    for key in inputs.keys:
+        press_level_key(key)
+    PROFILER.mark("player")
+
+
+# Class for a headless Simulation of the game's levels, one step per tick without window, drawing or sleeping
+class Simulation:
+    def __init__(self, lvl_id: str = None, savestate: Enum = None, file_dict: dict = None):
+        global SAVESTATE
+        if savestate is not None:
+            SAVESTATE = savestate
+        GLOBALS.headless = True
+        SCENES.switch("level")
+        GLOBALS.game_over = False
+        close_action_menu()
+        close_container()
+        self.tick = 0
+        start_level(lvl_id or SAVESTATE.level_id, file_dict)
+
+    # check if the run ended: game over, quit or the last level finished
+    def is_finished(self):
+        return GLOBALS.game_over or not SCENES.is_active("level") or GLOBALS.level_change
+
+    # advance by one tick, continuing in the next level when the current one is finished
+    def step(self, inputs: TickInput = None):
+        update_level(inputs or TickInput())
+        self.tick += 1
+        if GLOBALS.level_change and SAVESTATE.level_id != "credits":
+            start_level(SAVESTATE.level_id)
+        return self.get_state()
+
+    def get_state(self):
+        return {
+            "tick": self.tick,
+            "level_id": GLOBALS.level.lvl_id if GLOBALS.level else None,
+            "player_pos": tuple(GLOBALS.player.pos),
+            "facing": GLOBALS.player.facing,
+            "hp": SAVESTATE.hp,
+            "inventory": {k: (i.type, i.count) if i else None for k, i in ((k, SAVESTATE.inventory.content[k]) for k in INVENTORY_SLOTS)},
+            "enemies": [{"pos": (float(e.pos[0]), float(e.pos[1])), "hp": e.hp, "triggered": e.triggered} for e in GLOBALS.level.enemies] if GLOBALS.level else [],
+            "dialog_id": GLOBALS.dialog_id,
+            "paused": SCENES.top() == "pause",
+            "game_over": GLOBALS.game_over,
+            "finished": self.is_finished(),
+        }
+
+
+# Replay files: magic, version, then the zlib compressed JSON of the start SAVESTATE and the run-length encoded ticks
+REPLAY_MAGIC = b"LITWRPL\0"
+REPLAY_VERSION = 1
+REPLAY_HEADER = struct.Struct("<H")
+
+# Get the compact form of a TickInput: held keys as one string, presses and clicks only if there are any
+def encode_tick_input(inputs: TickInput):
+    entry = ["".join(inputs.held)]
+    if inputs.keys or inputs.clicks or inputs.quit:
+        entry += [list(inputs.keys), [list(c) for c in inputs.clicks], int(inputs.quit)]
+    return entry
+
+def decode_tick_input(entry: list):
+    if len(entry) == 1:
+        return TickInput(tuple(entry[0]))
+    return TickInput(tuple(entry[0]), entry[1], entry[2], bool(entry[3]))
+
+# Class for recording the TickInputs of a level session, starting from a SAVESTATE
+class InputRecorder:
+    def __init__(self, savestate: Enum):
+        self.savestate = savestate_to_data(savestate)
+        self.runs = [].copy()
+        self.ticks = 0
+
+    def record(self, inputs: TickInput):
+        entry = encode_tick_input(inputs)
+        # ticks with the same held keys and nothing pressed are merged into one run
+        if self.runs and len(entry) == 1 and self.runs[-1][1:] == entry:
+            self.runs[-1][0] += 1
+        else:
+            self.runs.append([1] + entry)
+        self.ticks += 1
+
+    def save(self, filename: str):
+        data = {"tick_rate": TICK_RATE, "savestate": self.savestate, "ticks": self.ticks, "runs": self.runs}
+        with open(filename, "wb") as file:
+            file.write(REPLAY_MAGIC + REPLAY_HEADER.pack(REPLAY_VERSION))
+            file.write(zlib.compress(json.dumps(data, separators = (",", ":")).encode("utf-8"), 9))
+
+# Class for a recorded Replay, feeding its TickInputs back in the same order
+class Replay:
+    def __init__(self, filename: str):
+        with open(filename, "rb") as file:
+            raw = file.read()
+        if raw[:len(REPLAY_MAGIC)] != REPLAY_MAGIC:
+            raise ValueError(f"{filename}: not a replay file")
+        version, = REPLAY_HEADER.unpack_from(raw, len(REPLAY_MAGIC))
+        if version != REPLAY_VERSION:
+            raise ValueError(f"{filename}: replay version {version}, expected {REPLAY_VERSION}")
+        data = json.loads(zlib.decompress(raw[len(REPLAY_MAGIC) + REPLAY_HEADER.size:]).decode("utf-8"))
+        if data["tick_rate"] != TICK_RATE:
+            raise ValueError(f"{filename}: recorded at {data['tick_rate']} ticks per second, the game runs at {TICK_RATE}")
+        self.savestate = data["savestate"]
+        self.runs = data["runs"]
+        self.ticks = data["ticks"]
+        self.rewind()
+
+    # a new SAVESTATE for every run, as playing changes it
+    def get_savestate(self):
+        return savestate_from_data(self.savestate)
+
+    def __iter__(self):
+        for run in self.runs:
+            inputs = decode_tick_input(run[1:])
+            for n in range(run[0]):
+                yield inputs
+
+    def __len__(self):
+        return self.ticks
+
+    def rewind(self):
+        self.position = iter(self)
+
+    # get the next count TickInputs, fewer at the end of the Replay
+    def take(self, count: int):
+        return list(islice(self.position, count))
+
+# Play a Replay with the Simulation as fast as possible, returns the timing of each run and the final state
+def run_replay_headless(replay: Replay, repeat: int = 1):
+    results = [].copy()
+    state = None
+    for n in range(repeat):
+        simulation = Simulation(None, replay.get_savestate())
+        start = time.perf_counter()
+        for inputs in replay:
+            state = simulation.step(inputs)
+            if simulation.is_finished():
+                break
+        seconds = time.perf_counter() - start
+        results.append({"ticks": simulation.tick, "seconds": round(seconds, 6), "ms_per_tick": round(seconds * 1000 / max(simulation.tick, 1), 6)})
+    return results, state
+
+
 # Setup Global Variables
 GLOBALS = Enum()
 
 GLOBALS.set(main_loop = True)
-GLOBALS.set(in_menu = True)
-GLOBALS.set(in_level_select = False)
-GLOBALS.set(in_level = False)
-GLOBALS.set(in_credits = False)
 GLOBALS.set(game_over = False)
-GLOBALS.set(game_paused = False)
 GLOBALS.set(level = None)
 GLOBALS.set(player = None)
 GLOBALS.set(update_view = True)
@@ -778,9 +3028,16 @@ GLOBALS.set(in_container = False)
 GLOBALS.set(open_container = None)
 GLOBALS.set(dialog = [].copy())
 GLOBALS.set(dialog_id = -1)
-GLOBALS.set(dialog_anmiation_frame = -1)
+GLOBALS.set(dialog_animation_frame = -1)
+GLOBALS.set(render_alpha = 1.0)
+GLOBALS.set(headless = HEADLESS)
+GLOBALS.set(replay = None)
+GLOBALS.set(recorder = None)
+GLOBALS.set(record_sessions = 0)
+GLOBALS.set(uncapped = False)
 
 GLOBALS.set(dev = False)
+GLOBALS.set(dirty_rects = True)
 
 
 # Setup the initial save state
@@ -794,319 +3051,317 @@ DEFAULT_SAVESTATE.set(inventory = Inventory().initialize())
 
 # Load savestate from file if available
 SAVESTATE = load_savestate(default = DEFAULT_SAVESTATE)
-save_savestate(SAVESTATE)
+
+# Setup the scenes, rebuilt when the translations change (and the level select with the savestate's level)
+SCENES = SceneManager()
+SCENES.register("menu", setup_menu, lambda: (MSG,))
+SCENES.register("level_select", setup_level_select, lambda: (MSG, SAVESTATE.level_id))
+SCENES.register("pause", setup_pause_menu, lambda: (MSG,))
+SCENES.register("credits", setup_credits, lambda: (MSG,))
+SCENES.switch("menu")
 
 CLOCK = pg.time.Clock()
     
 
 
-'''
-=========
-MAIN LOOP
-=========
-'''
-while GLOBALS.main_loop:
-    '''======
-    MAIN MENU
-    ======'''
-    if GLOBALS.in_menu:
-        screen_objects = setup_menu()
-
-        while GLOBALS.in_menu:
-            CLOCK.tick(FPS)
-            # Update Graphics View
-            if GLOBALS.update_view:
-                draw__clean(COLORS.brown)
-                draw(screen_objects.title)
-                draw(screen_objects.play)
-                draw(screen_objects.settings)
-                draw(screen_objects.quit)
-                draw__window()
-                GLOBALS.update_view = False
-
-            # Check for Inputs
-            for event in pg.event.get():
-                if event.type == pg.QUIT:
-                    GLOBALS.in_menu = False
-                    GLOBALS.main_loop = False
+# Parse the command line options
+def parse_args(args: list = None):
+    parser = argparse.ArgumentParser(description = "Lost in the Woods")
+    parser.add_argument("--record", metavar = "FILE", help = "record the input of each level session to a replay file (FILE, FILE-2, ...)")
+    parser.add_argument("--replay", metavar = "FILE", help = "play a replay file instead of reading input")
+    parser.add_argument("--headless", action = "store_true", help = "play the replay without a window, as fast as possible")
+    parser.add_argument("--uncapped", action = "store_true", help = "play the replay one tick per frame without waiting")
+    parser.add_argument("--repeat", type = int, default = 1, help = "number of headless replay runs")
+    parser.add_argument("--profile", action = "store_true", help = "start with the frame profiler (F3) enabled")
+    options = parser.parse_args(args)
+    if options.headless and not options.replay:
+        parser.error("--headless needs --replay, the game can't be played without a window")
+    return options
+
+# Save the recorded level session, if there is one, to its own replay file
+def save_recording(filename: str):
+    if GLOBALS.recorder is None:
+        return
+    GLOBALS.record_sessions += 1
+    GLOBALS.recorder.save(get_session_filename(filename, GLOBALS.record_sessions))
+    GLOBALS.recorder = None
+
+# Get the replay file of a recorded level session: the first one is the given file, later ones get a number (session-2.rpl)
+def get_session_filename(filename: str, session: int):
+    if session <= 1:
+        return filename
+    base, ext = os.path.splitext(filename)
+    return f"{base}-{session}{ext}"
+
+# Run the game
+def main(args: list = None):
+    global SAVESTATE
+    options = parse_args(args)
+    PROFILER.set_enabled(options.profile or bool(os.environ.get("RPG_PROFILE")))
+    
+    if options.replay:
+        replay = Replay(options.replay)
+        if GLOBALS.headless:
+            results, state = run_replay_headless(replay, options.repeat)
+            print(json.dumps({"replay": options.replay, "runs": results, "state": state}, indent = 4))
+            pg.quit()
+            return
+        
+        # the replay starts in its level, without touching the savestate file
+        GLOBALS.replay = replay
+        GLOBALS.uncapped = options.uncapped
+        SAVESTATE = replay.get_savestate()
+        SCENES.switch("level")
+        replay_start = time.perf_counter()
+        frames = 0
+    else:
+        save_savestate(SAVESTATE)
+    
+    '''
+    =========
+    MAIN LOOP
+    =========
+    '''
+    while GLOBALS.main_loop:
+        '''======
+        MAIN MENU
+        ======'''
+        if SCENES.top() == "menu":
+            screen_objects = SCENES.get("menu")
+
+            while SCENES.top() == "menu":
+                CLOCK.tick(FPS)
+                # Update Graphics View
+                if GLOBALS.update_view:
+                    draw__clean(COLORS.brown)
+                    draw(screen_objects.title)
+                    draw(screen_objects.play)
+                    draw(screen_objects.settings)
+                    draw(screen_objects.quit)
+                    draw__window()
+                    GLOBALS.update_view = False
 
-                if event.type == pg.MOUSEBUTTONDOWN:
-                    if screen_objects.quit.get_mouse_collision():
-                        GLOBALS.in_menu = False
+                # Check for Inputs, sleeping until there are any
+                for event in wait_events():
+                    if event.type == pg.QUIT:
+                        SCENES.switch()
                         GLOBALS.main_loop = False
-                    if screen_objects.play.get_mouse_collision():
-                        GLOBALS.in_menu = False
-                        GLOBALS.in_level_select = True
-                    GLOBALS.update_view = True
-
-                if event.type == pg.MOUSEMOTION:
-                    GLOBALS.update_view = True
-                
-                if event.type == pg.WINDOWFOCUSGAINED:
-                    GLOBALS.update_view = True
 
-    '''=========
-    LEVEL SELECT
-    ========='''
-    if GLOBALS.in_level_select:
-        screen_objects = setup_level_select()
-
-        while GLOBALS.in_level_select:
-            CLOCK.tick(FPS)
-            # Update Graphics View
-            if GLOBALS.update_view:
-                draw__clean(COLORS.brown)
-                draw(screen_objects.title)
-                draw(screen_objects.subtitle)
-                draw(screen_objects.cont)
-                draw(screen_objects.restart)
-                draw(screen_objects.back)
-                draw__window()
-                GLOBALS.update_view = False
-
-
-            # Check for Inputs
-            for event in pg.event.get():
-                if event.type == pg.QUIT:
-                    GLOBALS.in_level_select = False
-                    GLOBALS.main_loop = False
-
-                if event.type == pg.MOUSEBUTTONDOWN:
-                    if screen_objects.back.get_mouse_collision():
-                        GLOBALS.in_level_select = False
-                        GLOBALS.in_menu = True
-                    elif screen_objects.cont.get_mouse_collision():
-                        SAVESTATE = load_savestate()
-                        GLOBALS.in_level_select = False
-                        GLOBALS.in_level = True
-                    elif screen_objects.restart.get_mouse_collision():
-                        SAVESTATE = DEFAULT_SAVESTATE
-                        GLOBALS.in_level_select = False
-                        GLOBALS.in_level = True
-                    GLOBALS.update_view = True
+                    if event.type == pg.MOUSEBUTTONDOWN:
+                        if screen_objects.quit.get_mouse_collision():
+                            SCENES.switch()
+                            GLOBALS.main_loop = False
+                        if screen_objects.play.get_mouse_collision():
+                            SCENES.switch("level_select")
+                        GLOBALS.update_view = True
 
-                if event.type == pg.MOUSEMOTION:
-                    GLOBALS.update_view = True
-                
-                if event.type == pg.WINDOWFOCUSGAINED:
-                    GLOBALS.update_view = True
-            
-    '''=====
-    IN LEVEL
-    ====='''
-    if GLOBALS.in_level:
-        screen_objects, GLOBALS.level, GLOBALS.player = setup_level(SAVESTATE.level_id)
-
-        while GLOBALS.in_level and not GLOBALS.level_change:
-            CLOCK.tick(FPS)
-            # Update Graphics View
-            if GLOBALS.update_view:
-                
-                draw__clean()
-                background_pos = GLOBALS.player.get_background_pos()
-                draw(screen_objects.background.set_pos(background_pos))
-                
-                draw_hitboxes(screen_objects)
-                
-                # draw InteractableObjects
-                for i in GLOBALS.level.interactable_objects:
-                    draw(i.get_screen_object().set_pos((i.pos[0] + background_pos[0], i.pos[1] + background_pos[1])))
-                
-                # draw Enemies
-                for i in GLOBALS.level.enemies:
-                    if i.triggered:
-                        draw(i.get_screen_object().set_pos((i.pos[0] + background_pos[0], i.pos[1] + background_pos[1])))
-                        
-                draw(GLOBALS.player.get_screen_object())
-                
-                draw_inventory()
-                draw_hp()
-                
-                draw_dialog()
-                
-                # draw ActionMenu view
-                if GLOBALS.in_action_menu:
-                    draw(GLOBALS.action_menu.get_screen_object())
-                    for i in GLOBALS.action_menu.buttons:
-                        draw(i)
-                
-                # draw ItemContainer view
-                if GLOBALS.in_container:
-                    draw(GLOBALS.open_container.get_screen_object())
-                    for i in GLOBALS.open_container.buttons:
-                        draw(i)
-                
-                # draw pause menu
-                if GLOBALS.game_paused:
-                    draw(pause_menu_objects.overlay)
-                    
-                    draw(pause_menu_objects.title)
-                    draw(pause_menu_objects.cont)
-                    draw(pause_menu_objects.quit)
-                    
-                # draw game over screen
-                if GLOBALS.game_over:
-                    draw(ScreenObject(Surface((WIDTH, HEIGHT), Color(0, 0, 0, 127))).set((0, 0), 7))
-                    draw(ScreenObject(Text(MSG["game_over"], COLORS.red, font_size=3)).set((WIDTH // 2, HEIGHT // 2), 7, (True, True)))
-                
-                draw__window()
-                GLOBALS.update_view = False
-                
-                if GLOBALS.game_over:
-                    time.sleep(5)
-                    GLOBALS.in_level = False
-                    GLOBALS.in_menu = True
-            
-            if not GLOBALS.game_paused:
-                # advance the dialog text animation
-                if GLOBALS.dialog_animation_frame >= 0:
-                    if GLOBALS.dialog_animation_frame < len(GLOBALS.dialog[GLOBALS.dialog_id]):
-                        GLOBALS.dialog_animation_frame += 1
+                    if event.type == pg.MOUSEMOTION:
                         GLOBALS.update_view = True
-                
-                # move enemies toward the player
-                for e in GLOBALS.level.enemies:
-                    if e.triggered:
-                        if e.pursuit:
-                            e.current_move_timeout -= 1
-                            if e.current_move_timeout <= 0:
-                                e.calculate_move()
-                                GLOBALS.update_view = True
-                        e.update_attack_animation()
-                    elif e.check_trigger():
-                        e.triggered = True
-            
-            # Check for hold buttons for movement
-            if not GLOBALS.game_paused:
-                if pg.key.get_pressed()[pg.K_w]:
-                    GLOBALS.player.move((0, -GLOBALS.level.movement_speed))
-                    GLOBALS.update_view = True
-                if pg.key.get_pressed()[pg.K_s]:
-                    GLOBALS.player.move((0, GLOBALS.level.movement_speed))
-                    GLOBALS.update_view = True
-                if pg.key.get_pressed()[pg.K_a]:
-                    GLOBALS.player.move((-GLOBALS.level.movement_speed, 0))
-                    GLOBALS.update_view = True
-                if pg.key.get_pressed()[pg.K_d]:
-                    GLOBALS.player.move((GLOBALS.level.movement_speed, 0))
-                    GLOBALS.update_view = True
-            
-            # Check for inputs
-            for event in pg.event.get():
-                if event.type == pg.QUIT:
-                    GLOBALS.in_level = False
-                    GLOBALS.main_loop = False
-                
-                if event.type == pg.WINDOWFOCUSGAINED:
-                    GLOBALS.update_view = True
-                
-                if event.type == pg.MOUSEMOTION:
-                    GLOBALS.update_view = True
-                    
-                if event.type == pg.MOUSEBUTTONDOWN:
-                    # if in the pause menu
-                    if GLOBALS.game_paused:
-                        if pause_menu_objects.cont.get_mouse_collision():
-                            GLOBALS.game_paused = not GLOBALS.game_paused
-                        elif pause_menu_objects.quit.get_mouse_collision():
-                            GLOBALS.in_level = False
-                            GLOBALS.level = None
-                            GLOBALS.game_paused = False
-                            GLOBALS.in_menu = True
-                            
-                    # if in an ActionMenu view
-                    elif GLOBALS.in_action_menu:
-                        for b in GLOBALS.action_menu.buttons:
-                            if b.get_mouse_collision():
-                                activate_action(b.content)
-                                
-                    # if in an ItemContainer view
-                    elif GLOBALS.in_container:
-                        for b in GLOBALS.open_container.buttons:
-                            if b.get_mouse_collision():
-                                if GLOBALS.open_container.remove_item(b.item):
-                                    i = GLOBALS.player.collect_item(b.item)
-                                    if i: GLOBALS.open_container.add_item(i)
-                                    GLOBALS.open_container.update_surface()
-                            
-                    GLOBALS.update_view = True
-                
-                if event.type == pg.KEYDOWN:
-                    if event.key == pg.K_ESCAPE:
-                        GLOBALS.game_paused = not GLOBALS.game_paused
-                        if GLOBALS.game_paused:
-                            pause_menu_objects = setup_pause_menu()
+
+                    if event.type == pg.WINDOWFOCUSGAINED:
                         GLOBALS.update_view = True
-                    if event.key == pg.K_F2:
-                        screenshot("1.0")
-                        
-                    if not GLOBALS.game_paused:
-                        if GLOBALS.dialog_id >= 0:
-                            if event.key == pg.K_SPACE:
-                                advance_dialog()
-                                
-                        if event.key == pg.K_q:
-                            use_consumable()
-                            
-                        if event.key == pg.K_e:
-                            use_primary()
-                            
-                    GLOBALS.update_view = True
 
-        GLOBALS.level_change = False
-        
-        '''====
-        CREDITS
-        ===='''
-        if SAVESTATE.level_id == "credits":
-            pages = setup_credits()
-            
-            page_id = 0
-            
-            while GLOBALS.in_credits:
-                CLOCK.tick(30)
-                        
+        '''=========
+        LEVEL SELECT
+        ========='''
+        if SCENES.top() == "level_select":
+            screen_objects = SCENES.get("level_select")
+
+            while SCENES.top() == "level_select":
+                CLOCK.tick(FPS)
+                # Update Graphics View
                 if GLOBALS.update_view:
-                    draw__clean()
-                    
-                    for so in pages[page_id]:
-                        draw(so)
-                    
+                    draw__clean(COLORS.brown)
+                    draw(screen_objects.title)
+                    draw(screen_objects.subtitle)
+                    draw(screen_objects.cont)
+                    draw(screen_objects.restart)
+                    draw(screen_objects.back)
                     draw__window()
-                    
-                for event in pg.event.get():
+                    GLOBALS.update_view = False
+
+
+                # Check for Inputs, sleeping until there are any
+                for event in wait_events():
                     if event.type == pg.QUIT:
-                        GLOBALS.in_credits = False
+                        SCENES.switch()
                         GLOBALS.main_loop = False
-                    
-                    if event.type == pg.KEYDOWN:
-                        if event.key == pg.K_SPACE:
-                            page_id += 1
-                            if page_id >= len(pages):
-                                GLOBALS.in_credits = False
-                                GLOBALS.in_menu = True
-                                
-                        if event.key == pg.K_ESCAPE:
-                            GLOBALS.in_credits = False
-                            GLOBALS.in_menu = True
-                            
+
+                    if event.type == pg.MOUSEBUTTONDOWN:
+                        if screen_objects.back.get_mouse_collision():
+                            SCENES.switch("menu")
+                        elif screen_objects.cont.get_mouse_collision():
+                            SAVESTATE = load_savestate()
+                            SCENES.switch("level")
+                        elif screen_objects.restart.get_mouse_collision():
+                            # a copy, playing must not change the default savestate
+                            SAVESTATE = savestate_from_data(savestate_to_data(DEFAULT_SAVESTATE))
+                            SCENES.switch("level")
                         GLOBALS.update_view = True
+
+                    if event.type == pg.MOUSEMOTION:
+                        GLOBALS.update_view = True
+
+                    if event.type == pg.WINDOWFOCUSGAINED:
+                        GLOBALS.update_view = True
+
+        '''=====
+        IN LEVEL
+        ====='''
+        if SCENES.top() == "level":
+            if options.record and GLOBALS.recorder is None:
+                GLOBALS.recorder = InputRecorder(SAVESTATE)
+            screen_objects = setup_level(SAVESTATE.level_id)[0]
+            renderer = LevelRenderer(GLOBALS.dirty_rects)
+            timestep = FixedTimestep()
+            keys = [].copy()
+            clicks = [].copy()
+            held = [].copy()
+
+            while SCENES.is_active("level") and not GLOBALS.level_change:
+                PROFILER.start_frame()
+                if SCENES.top() == "pause" and GLOBALS.replay is None:
+                    # nothing moves in the pause menu, sleep until there is input
+                    events = wait_events()
+                    CLOCK.tick(FPS)
+                    timestep.reset()
+                    PROFILER.mark("wait")
+                elif not GLOBALS.uncapped and not GLOBALS.update_view and not is_interpolating():
+                    # nothing to draw until the next tick, sleep until it is due or there is input
+                    events = wait_events(max(1, int(timestep.get_wait() * 1000)))
+                    CLOCK.tick()
+                    PROFILER.mark("wait")
+                else:
+                    if not GLOBALS.uncapped:
+                        CLOCK.tick(MAX_FPS)
+                    PROFILER.mark("wait")
+                    events = pg.event.get()
+
+                # Check for view events, the rest is input for the level simulation
+                for event in events:
+                    if event.type == pg.WINDOWFOCUSGAINED:
+                        renderer.invalidate()
+                        GLOBALS.update_view = True
+
+                    if event.type == pg.MOUSEMOTION:
+                        GLOBALS.update_view = True
+
+                    if event.type == pg.KEYDOWN and event.key == pg.K_F2:
+                        screenshot("1.0")
+
+                    if event.type == pg.KEYDOWN and event.key == pg.K_F3:
+                        PROFILER.set_enabled(not PROFILER.enabled)
+                        GLOBALS.update_view = True
+
+                inputs = read_tick_input(events)
+                PROFILER.mark("events")
+                if GLOBALS.replay is not None:
+                    # the replay gives the input of every tick, uncapped it runs one tick per frame
+                    frames += 1
+                    count = 1 if GLOBALS.uncapped else timestep.advance()
+                    tick_inputs = GLOBALS.replay.take(count)
+                    if len(tick_inputs) < count or inputs.quit:
+                        tick_inputs.append(TickInput(quit = True))
+                else:
+                    # presses wait for the next tick, held keys count in every tick
+                    # and a movement key held in any frame since the last tick (a short tap) in the next one
+                    keys += inputs.keys
+                    clicks += inputs.clicks
+                    held = [k for k in MOVEMENT_KEYS if k in held or k in inputs.held]
+                    # while paused, input is handled right away in a tick of its own
+                    ticks = int(bool(keys or clicks)) if SCENES.top() == "pause" else timestep.advance()
+                    tick_inputs = [].copy()
+                    for n in range(ticks):
+                        tick_inputs.append(TickInput(held if n == 0 else inputs.held, keys, clicks, inputs.quit))
+                        keys = [].copy()
+                        clicks = [].copy()
+                    if ticks:
+                        held = [].copy()
+                    if inputs.quit and not tick_inputs:
+                        tick_inputs.append(TickInput(quit = True))
                 
-            SAVESTATE = load_savestate(SAVESTATE)
+                for tick_input in tick_inputs:
+                    if GLOBALS.recorder is not None:
+                        GLOBALS.recorder.record(tick_input)
+                    update_level(tick_input)
+                    if not SCENES.is_active("level") or GLOBALS.level_change:
+                        break
+                if not SCENES.is_active("level") or GLOBALS.level_change:
+                    break
+
+                # Update Graphics View
+                GLOBALS.render_alpha = timestep.get_alpha()
+                if GLOBALS.update_view or is_interpolating():
+                    # only the changed regions are redrawn, a scrolled camera redraws everything
+                    renderer.render(screen_objects)
+                    GLOBALS.update_view = False
 
+                    if GLOBALS.game_over:
+                        time.sleep(5)
+                        SCENES.switch("menu")
 
+                PROFILER.end_frame()
 
+            GLOBALS.render_alpha = 1.0
+            GLOBALS.level_change = False
 
+            # a session ends when the player leaves the level or reaches the credits
+            if not SCENES.is_active("level") or SAVESTATE.level_id == "credits":
+                save_recording(options.record)
 
+                if GLOBALS.replay is not None:
+                    seconds = time.perf_counter() - replay_start
+                    print(json.dumps({"replay": options.replay, "ticks": len(GLOBALS.replay), "frames": frames, "seconds": round(seconds, 6),
+                        "ms_per_frame": round(seconds * 1000 / max(frames, 1), 6)}, indent = 4))
+                    GLOBALS.main_loop = False
 
+            # the player quit or lost, the next level isn't needed anymore
+            if not SCENES.is_active("level"):
+                PRELOADER.cancel()
 
+            '''====
+            CREDITS
+            ===='''
+            if SAVESTATE.level_id == "credits" and GLOBALS.main_loop:
+                SCENES.switch("credits")
+                pages = SCENES.get("credits")
 
+                page_id = 0
 
+                while SCENES.top() == "credits":
+                    CLOCK.tick(30)
 
+                    if GLOBALS.update_view:
+                        draw__clean()
 
+                        for so in pages[page_id]:
+                            draw(so)
 
+                        draw__window()
+                        GLOBALS.update_view = False
 
+                    for event in wait_events():
+                        if event.type == pg.QUIT:
+                            SCENES.switch()
+                            GLOBALS.main_loop = False
 
+                        if event.type == pg.KEYDOWN:
+                            if event.key == pg.K_SPACE:
+                                page_id += 1
+                                if page_id >= len(pages):
+                                    SCENES.switch("menu")
+
+                            if event.key == pg.K_ESCAPE:
+                                SCENES.switch("menu")
+
+                            GLOBALS.update_view = True
+
+                SAVESTATE = load_savestate(SAVESTATE)
+    
+    save_recording(options.record)
+    SAVER.flush()
+    pg.quit()
 
 
-pg.quit()
+if __name__ == "__main__":
+    main()
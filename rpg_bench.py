@@ -0,0 +1,234 @@
+#!/bin/python3
+
+# Benchmarks for the hot paths of the RPG, run headless with SDL's dummy video driver.
+# Every benchmark runs on synthetic levels of increasing size: a real level (its
+# background, settings and objects) filled with N extra obstacle hitboxes and N enemies.
+#
+#   python rpg_bench.py [--sizes 10 100 1000] [--base 02] [--output results.json]
+#   python rpg_bench.py --compare baseline.json [--threshold 0.1]
+#   python rpg_bench.py --memory [--sizes 1000 10000]
+#
+# The results are printed (or written) as JSON:
+#   {"meta": {...}, "results": {"<benchmark>[<size>]": {"calls": n, "median_us": t, "min_us": t, "max_us": t}}}
+# Compare mode prints the ratio of every median to the baseline and exits with 1
+# if any benchmark got slower than the threshold.
+# Memory mode prints the memory report of the synthetic level of every size instead:
+#   {"<size>": {"<type>": {"count": n, "bytes": b}}}
+
+import os
+
+os.environ.setdefault("RPG_HEADLESS", "1")
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+import argparse
+import json
+import platform
+import statistics
+import sys
+import time
+
+import rpg
+
+SIZES = (10, 100, 1000)
+BASE_LEVEL = "02"
+ENEMY_HP = 10 ** 9
+
+
+'''
+===============
+SYNTHETIC LEVELS
+==============='''
+
+# Get a level file dict with size extra obstacle hitboxes and enemies spread over the base level,
+# keeping the surroundings of the starting position free
+def synthetic_level(size: int, base: str = None):
+    base = base or BASE_LEVEL
+    data = rpg.load_level_file(base)
+    level_size = rpg.TiledBackground(base, data.get("background")).size
+    start = data["starting_pos"]
+    template = data["enemies"][0] if data.get("enemies") else {
+        "image": "entities/slime.png", "pursuit": True, "speed": 20, "move_timeout": 10,
+        "attack": {"type": "jump", "damage": 10, "frames": 5, "timeout": 50}}
+
+    columns = max(1, int(size ** 0.5))
+    step = (level_size[0] // (columns + 1), level_size[1] // (-(-size // columns) + 1))
+    positions = [].copy()
+    for n in range(size):
+        pos = [step[0] * (n % columns + 1), step[1] * (n // columns + 1)]
+        if abs(pos[0] - start[0]) < 160 and abs(pos[1] - start[1]) < 160:
+            pos[0] = (pos[0] + 320) % level_size[0]
+        positions.append(pos)
+
+    data["obstacle_hitboxes"] = data.get("obstacle_hitboxes", [].copy()) + [
+        {"type": "nature", "start": [x, y], "end": [x + 32, y + 32]} for x, y in positions]
+    data["enemies"] = [dict(template, start_pos = [x + 16, y + 48], hp = ENEMY_HP, trigger = {"type": "always"}) for x, y in positions]
+    return data
+
+# Start a synthetic level in the simulation, with an axe and enough HP to survive every benchmark
+def start_synthetic_level(size: int, base: str = None):
+    base = base or BASE_LEVEL
+    savestate = rpg.savestate_from_data(rpg.savestate_to_data(rpg.DEFAULT_SAVESTATE))
+    savestate.hp = ENEMY_HP
+    savestate.inventory.set_item(rpg.Item("axe", 1, "primary", {"damage": 10}), "primary")
+    rpg.Simulation(base, savestate, synthetic_level(size, base))
+    rpg.GLOBALS.level.trigger_index.update(rpg.GLOBALS.player.pos)
+    return rpg.GLOBALS.level
+
+
+'''
+=========
+BENCHMARKS
+========='''
+
+# Measure the time per call of fn, calibrated so each of the repeats runs for about min_time / repeat seconds
+def measure(fn, min_time: float = 0.5, repeat: int = 5):
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for n in range(number):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time / repeat / 4 or number >= 1 << 20:
+            break
+        number *= 4
+    number = max(1, int(number * (min_time / repeat) / max(elapsed, 1e-9)))
+
+    times = [].copy()
+    for r in range(repeat):
+        start = time.perf_counter()
+        for n in range(number):
+            fn()
+        times.append((time.perf_counter() - start) / number * 1e6)
+    return {"calls": number * repeat, "median_us": round(statistics.median(times), 3),
+        "min_us": round(min(times), 3), "max_us": round(max(times), 3)}
+
+# Construct the Level from its (already loaded) file dict
+def bench_level_load(size: int):
+    data = synthetic_level(size)
+    return lambda: rpg.Level(BASE_LEVEL, {}, data)
+
+# Move the player in a square against the level's hitboxes
+def bench_player_move(size: int):
+    level = start_synthetic_level(size)
+    moves = [(level.movement_speed, 0), (0, level.movement_speed), (-level.movement_speed, 0), (0, -level.movement_speed)]
+    state = {"n": 0}
+    def fn():
+        rpg.GLOBALS.player.move(moves[state["n"] % 4])
+        state["n"] += 1
+    return fn
+
+# Advance all enemies of the level by one tick (timeouts, pursuit and attacks)
+def bench_enemy_update(size: int):
+    level = start_synthetic_level(size)
+    return level.enemy_batch.update
+
+# Hit test the player's attack against all enemies
+def bench_use_primary(size: int):
+    start_synthetic_level(size)
+    return rpg.use_primary
+
+# Reveal the start dialog of the level glyph by glyph, starting over at its end
+def bench_draw_dialog(size: int):
+    start_synthetic_level(size)
+    line = len(rpg.GLOBALS.dialog[rpg.GLOBALS.dialog_id])
+    def fn():
+        rpg.GLOBALS.dialog_animation_frame = rpg.GLOBALS.dialog_animation_frame % line + 1
+        rpg.draw_dialog()
+    return fn
+
+# Draw the HUD (inventory, HP and enemy HP) after the inventory changed
+def bench_draw_hud(size: int):
+    start_synthetic_level(size)
+    def fn():
+        rpg.SAVESTATE.inventory.touch()
+        rpg.draw_hud()
+    return fn
+
+# Run one tick of the level and render the view, walking back and forth
+def bench_frame(size: int):
+    level = start_synthetic_level(size)
+    screen_objects = rpg.get_level_screen_objects(level)
+    renderer = rpg.LevelRenderer(rpg.GLOBALS.dirty_rects)
+    held = [("d",)] * 10 + [("a",)] * 10
+    state = {"n": 0}
+    def fn():
+        rpg.update_level(rpg.TickInput(held[state["n"] % len(held)]))
+        renderer.render(screen_objects)
+        state["n"] += 1
+    return fn
+
+BENCHMARKS = {
+    "level_load": bench_level_load,
+    "player_move": bench_player_move,
+    "enemy_update": bench_enemy_update,
+    "use_primary": bench_use_primary,
+    "draw_dialog": bench_draw_dialog,
+    "draw_hud": bench_draw_hud,
+    "frame": bench_frame,
+}
+
+# Run the benchmarks for all sizes, returns the results JSON
+def run_benchmarks(names: list, sizes: list, min_time: float = 0.5):
+    results = {}.copy()
+    for name in names:
+        for size in sizes:
+            key = f"{name}[{size}]"
+            results[key] = measure(BENCHMARKS[name](size), min_time)
+            print(f"{key}: {results[key]['median_us']} us", file = sys.stderr)
+    meta = {"python": platform.python_version(), "pygame": rpg.pg.version.ver, "platform": platform.platform(),
+        "base_level": BASE_LEVEL, "sizes": list(sizes), "time": time.strftime("%Y-%m-%dT%H:%M:%S")}
+    return {"meta": meta, "results": results}
+
+# Get the memory report of the synthetic level of every size
+def memory_reports(sizes: list):
+    return {str(size): rpg.Level(BASE_LEVEL, {}, synthetic_level(size)).get_memory_report() for size in sizes}
+
+# Compare results with a baseline, returns the lines to print and whether anything got slower than the threshold
+def compare(results: dict, baseline: dict, threshold: float = 0.1):
+    lines = [].copy()
+    regression = False
+    for key, result in results["results"].items():
+        if key not in baseline["results"]:
+            lines.append(f"{key:<24} {result['median_us']:>12.3f} us   (new)")
+            continue
+        ratio = result["median_us"] / max(baseline["results"][key]["median_us"], 1e-9)
+        flag = ""
+        if ratio > 1 + threshold:
+            flag = "  SLOWER"
+            regression = True
+        elif ratio < 1 - threshold:
+            flag = "  faster"
+        lines.append(f"{key:<24} {result['median_us']:>12.3f} us   {baseline['results'][key]['median_us']:>12.3f} us   x{ratio:.2f}{flag}")
+    return lines, regression
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the hot paths of the RPG on synthetic levels.")
+    parser.add_argument("--sizes", nargs="+", type=int, default=list(SIZES), help="numbers of extra hitboxes and enemies")
+    parser.add_argument("--only", nargs="+", choices=list(BENCHMARKS), default=list(BENCHMARKS), help="benchmarks to run")
+    parser.add_argument("--base", default=BASE_LEVEL, help="level the synthetic levels are built on")
+    parser.add_argument("--min-time", type=float, default=0.5, help="seconds to measure each benchmark")
+    parser.add_argument("--output", help="write the results JSON to this file")
+    parser.add_argument("--compare", metavar="BASELINE", help="compare with the results JSON of an earlier run")
+    parser.add_argument("--threshold", type=float, default=0.1, help="relative slowdown counted as a regression")
+    parser.add_argument("--memory", action="store_true", help="print the memory report of the synthetic levels instead")
+    args = parser.parse_args()
+
+    BASE_LEVEL = args.base
+    if args.memory:
+        print(json.dumps(memory_reports(args.sizes), indent=4))
+        sys.exit(0)
+    results = run_benchmarks(args.only, args.sizes, args.min_time)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=4)
+
+    if args.compare:
+        with open(args.compare, "r") as file:
+            lines, regression = compare(results, json.load(file), args.threshold)
+        print("\n".join(lines))
+        sys.exit(1 if regression else 0)
+    elif not args.output:
+        print(json.dumps(results, indent=4))
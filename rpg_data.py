@@ -0,0 +1,496 @@
+#!/bin/python3
+
+# Data formats of the RPG: tagged JSON for levels, credits, translations and
+# savestates, its validator and the compiled binary level cache.
+#
+# Constructors are tagged instead of being written as Python expressions:
+#   {"$type": "Item", "type": "axe", "count": 1, "slot": "primary", "data": {...}}
+#   {"$type": "ItemContainer", "items": [...]}
+#   {"$color": "grey_green"}
+#
+# Savestates are the same tagged JSON, compressed behind a versioned header with a
+# checksum (see encode_savestate) and always replaced atomically. The savestates of the
+# first versions, the Python repr of the savestate, are parsed (not evaluated) as well.
+#
+# Run this file to compile all levels into the cache:
+#   python rpg_data.py [--levels levels_dir] [--cache cache_dir] [--action-types type ...]
+# where --action-types names the action types the game registers on top of the built-in ones
+# or to split level backgrounds into tiles (needs pygame):
+#   python rpg_data.py --tiles 01 02 [--tile-size 256]
+
+import argparse
+import ast
+import json
+import marshal
+import os
+import struct
+import sys
+import zlib
+
+LEVELS_DIR = "__RESOURCES__/rpg/data/levels"
+IMAGES_DIR = "__RESOURCES__/rpg/images"
+CACHE_DIR = "__CACHE__/levels"
+
+CACHE_MAGIC = b"LITWLVL\0"
+CACHE_VERSION = 1
+CACHE_HEADER = struct.Struct("<HHqq")
+
+SAVE_MAGIC = b"LITWSAV\0"
+SAVE_VERSION = 1
+SAVE_HEADER = struct.Struct("<HII")
+
+ITEM_SLOTS = ("primary", "secondary", "consumable")
+# the built-in action types, the game passes the ones it registers (see register_action in rpg.py) to the validation
+ACTION_TYPES = ("del", "transform", "advance", "ItemContainer")
+TRIGGER_TYPES = ("rect", "radius", "union", "always")
+
+
+# Error for data files not matching their schema
+class DataFormatError(ValueError):
+    pass
+
+
+'''
+=======
+DECODING
+======='''
+
+# Replace the tagged objects in data by the objects built by constructors / colors
+def decode(data, constructors: dict, colors: dict = {}.copy()):
+    if isinstance(data, list):
+        return [decode(i, constructors, colors) for i in data]
+    if isinstance(data, dict):
+        if "$color" in data:
+            return colors[data["$color"]]
+        fields = {k: decode(v, constructors, colors) for k, v in data.items() if k != "$type"}
+        if "$type" in data:
+            return constructors[data["$type"]](fields)
+        return fields
+    return data
+
+# Read and decode a plain JSON file
+def read_json(path: str):
+    with open(path, "r") as file:
+        return json.load(file)
+
+
+'''
+=========
+VALIDATION
+========='''
+
+# Class collecting the schema errors of one data file
+class Validator:
+    def __init__(self, name: str, action_types: tuple = ACTION_TYPES):
+        self.name = name
+        self.action_types = action_types
+        self.errors = [].copy()
+
+    def error(self, path: str, message: str):
+        self.errors.append(f"{self.name}: {path}: {message}")
+
+    def check(self):
+        if self.errors:
+            raise DataFormatError("\n".join(self.errors))
+
+    def require(self, d: dict, key: str, path: str, types: tuple):
+        if key not in d:
+            self.error(path, f"missing key '{key}'")
+            return False
+        return self.type(d[key], f"{path}.{key}", types)
+
+    def type(self, value, path: str, types: tuple):
+        if isinstance(value, bool) and bool not in types:
+            self.error(path, f"expected {'/'.join(t.__name__ for t in types)}, got bool")
+            return False
+        if not isinstance(value, types):
+            self.error(path, f"expected {'/'.join(t.__name__ for t in types)}, got {type(value).__name__}")
+            return False
+        return True
+
+    def point(self, value, path: str):
+        if self.type(value, path, (list,)):
+            if len(value) != 2:
+                self.error(path, "expected a point [x, y]")
+            for n, c in enumerate(value):
+                self.type(c, f"{path}[{n}]", (int, float))
+
+    def tag(self, value, path: str, tag: str):
+        if not self.type(value, path, (dict,)):
+            return False
+        if value.get("$type") != tag:
+            self.error(path, f"expected a tagged '{tag}'")
+            return False
+        return True
+
+    def item(self, value, path: str):
+        if self.tag(value, path, "Item"):
+            self.require(value, "type", path, (str,))
+            if "count" in value and self.type(value["count"], f"{path}.count", (int,)) and value["count"] < 1:
+                self.error(f"{path}.count", "must be at least 1")
+            if "slot" in value and self.type(value["slot"], f"{path}.slot", (str,)) and value["slot"] not in ITEM_SLOTS:
+                self.error(f"{path}.slot", f"unknown slot '{value['slot']}'")
+            if "data" in value:
+                self.type(value["data"], f"{path}.data", (dict,))
+
+    def item_container(self, value, path: str):
+        if self.tag(value, path, "ItemContainer"):
+            if self.require(value, "items", path, (list,)):
+                for n, i in enumerate(value["items"]):
+                    self.item(i, f"{path}.items[{n}]")
+
+    def color(self, value, path: str, colors):
+        if not self.type(value, path, (dict,)) or not isinstance(value.get("$color"), str):
+            self.error(path, "expected a tagged color {\"$color\": name}")
+        elif colors is not None and value["$color"] not in colors:
+            self.error(path, f"unknown color '{value['$color']}'")
+
+    def trigger(self, value, path: str):
+        if not self.type(value, path, (dict,)):
+            return
+        if not self.require(value, "type", path, (str,)):
+            return
+        if value["type"] not in TRIGGER_TYPES:
+            self.error(f"{path}.type", f"unknown trigger type '{value['type']}'")
+        elif value["type"] == "rect":
+            for k in ("start", "end"):
+                if k in value and self.type(value[k], f"{path}.{k}", (list,)):
+                    if len(value[k]) != 2:
+                        self.error(f"{path}.{k}", "expected a point [x, y]")
+                    for n, c in enumerate(value[k]):
+                        if c is not None:
+                            self.type(c, f"{path}.{k}[{n}]", (int, float))
+        elif value["type"] == "radius":
+            if "center" in value:
+                self.point(value["center"], f"{path}.center")
+            else:
+                self.error(path, "missing key 'center'")
+            self.require(value, "radius", path, (int, float))
+        elif value["type"] == "union":
+            if self.require(value, "zones", path, (list,)):
+                for n, z in enumerate(value["zones"]):
+                    self.trigger(z, f"{path}.zones[{n}]")
+
+    def interactable_object(self, value, path: str):
+        if not self.type(value, path, (dict,)):
+            return
+        self.require(value, "type", path, (str,))
+        self.require(value, "image", path, (str,))
+        self.require(value, "description", path, (str,))
+        if "pos" in value:
+            self.point(value["pos"], f"{path}.pos")
+        else:
+            self.error(path, "missing key 'pos'")
+        if self.require(value, "actions", path, (list,)):
+            for n, a in enumerate(value["actions"]):
+                self.action(a, f"{path}.actions[{n}]")
+
+    def action(self, value, path: str):
+        if not self.type(value, path, (dict,)):
+            return
+        self.require(value, "name", path, (str,))
+        if not self.require(value, "type", path, (str,)):
+            return
+        if value["type"] not in self.action_types:
+            self.error(f"{path}.type", f"unknown action type '{value['type']}'")
+        if "required" in value:
+            if self.type(value["required"], f"{path}.required", (dict,)):
+                for k, i in value["required"].items():
+                    if k not in ITEM_SLOTS:
+                        self.error(f"{path}.required", f"unknown slot '{k}'")
+                    self.type(i, f"{path}.required.{k}", (str,))
+            self.require(value, "required_dialog", path, (str,))
+        if value["type"] == "transform":
+            if "transform" in value:
+                self.interactable_object(value["transform"], f"{path}.transform")
+            else:
+                self.error(path, "missing key 'transform'")
+        elif value["type"] == "ItemContainer":
+            if "constructor" in value:
+                self.item_container(value["constructor"], f"{path}.constructor")
+            else:
+                self.error(path, "missing key 'constructor'")
+
+    def enemy(self, value, path: str):
+        if not self.type(value, path, (dict,)):
+            return
+        self.require(value, "image", path, (str,))
+        self.require(value, "pursuit", path, (bool,))
+        for k in ("speed", "hp", "move_timeout"):
+            self.require(value, k, path, (int, float))
+        if "start_pos" in value:
+            self.point(value["start_pos"], f"{path}.start_pos")
+        else:
+            self.error(path, "missing key 'start_pos'")
+        if "trigger" in value:
+            self.trigger(value["trigger"], f"{path}.trigger")
+        else:
+            self.error(path, "missing key 'trigger'")
+        if self.require(value, "attack", path, (dict,)):
+            self.require(value["attack"], "type", f"{path}.attack", (str,))
+            for k in ("damage", "frames", "timeout"):
+                self.require(value["attack"], k, f"{path}.attack", (int,))
+        if "drops" in value and self.type(value["drops"], f"{path}.drops", (list,)):
+            for n, i in enumerate(value["drops"]):
+                self.item(i, f"{path}.drops[{n}]")
+
+# Validate the data of a level file, raises DataFormatError
+def validate_level(data, name: str = "level", action_types: tuple = ACTION_TYPES):
+    v = Validator(name, action_types)
+    if not v.type(data, "$", (dict,)):
+        v.check()
+    if "obstacle_hitboxes" in data and v.type(data["obstacle_hitboxes"], "$.obstacle_hitboxes", (list,)):
+        for n, o in enumerate(data["obstacle_hitboxes"]):
+            path = f"$.obstacle_hitboxes[{n}]"
+            if v.type(o, path, (dict,)):
+                v.require(o, "type", path, (str,))
+                for k in ("start", "end"):
+                    if k in o:
+                        v.point(o[k], f"{path}.{k}")
+                    else:
+                        v.error(path, f"missing key '{k}'")
+    if "interactable_objects" in data and v.type(data["interactable_objects"], "$.interactable_objects", (list,)):
+        for n, i in enumerate(data["interactable_objects"]):
+            v.interactable_object(i, f"$.interactable_objects[{n}]")
+    if "enemies" in data and v.type(data["enemies"], "$.enemies", (list,)):
+        for n, e in enumerate(data["enemies"]):
+            v.enemy(e, f"$.enemies[{n}]")
+    if "background" in data and v.type(data["background"], "$.background", (dict,)):
+        if "size" in data["background"]:
+            v.point(data["background"]["size"], "$.background.size")
+        else:
+            v.error("$.background", "missing key 'size'")
+        v.require(data["background"], "tile_size", "$.background", (int,))
+    v.require(data, "movement_speed", "$", (int, float))
+    v.require(data, "start_dialog", "$", (str,))
+    v.require(data, "target", "$", (str,))
+    v.require(data, "next_level", "$", (str,))
+    if "starting_pos" in data:
+        v.point(data["starting_pos"], "$.starting_pos")
+    else:
+        v.error("$", "missing key 'starting_pos'")
+    v.check()
+    return data
+
+# Validate the data of the credits file, raises DataFormatError
+def validate_credits(data, name: str = "credits", colors = None):
+    v = Validator(name)
+    if v.type(data, "$", (dict,)) and v.require(data, "pages", "$", (list,)):
+        for n, p in enumerate(data["pages"]):
+            if v.type(p, f"$.pages[{n}]", (list,)):
+                for m, i in enumerate(p):
+                    path = f"$.pages[{n}][{m}]"
+                    if v.type(i, path, (dict,)):
+                        v.require(i, "text", path, (str,))
+                        v.require(i, "size", path, (int, float))
+                        if "color" in i:
+                            v.color(i["color"], f"{path}.color", colors)
+                        else:
+                            v.error(path, "missing key 'color'")
+    v.check()
+    return data
+
+# Validate the data of a translation file, raises DataFormatError
+def validate_translations(data, name: str = "translations"):
+    v = Validator(name)
+    if v.type(data, "$", (dict,)):
+        for k, i in data.items():
+            if v.type(i, f"$.{k}", (str, list)) and isinstance(i, list):
+                for n, line in enumerate(i):
+                    v.type(line, f"$.{k}[{n}]", (str,))
+    v.check()
+    return data
+
+# Validate the data of a savestate, raises DataFormatError
+def validate_savestate(data, name: str = "savestate"):
+    v = Validator(name)
+    if v.type(data, "$", (dict,)):
+        v.require(data, "name", "$", (str,))
+        v.require(data, "level_id", "$", (str,))
+        v.require(data, "xp", "$", (int,))
+        v.require(data, "hp", "$", (int,))
+        if v.require(data, "inventory", "$", (dict,)) and v.tag(data["inventory"], "$.inventory", "Inventory"):
+            for k in ITEM_SLOTS:
+                if data["inventory"].get(k) is not None:
+                    v.item(data["inventory"][k], f"$.inventory.{k}")
+    v.check()
+    return data
+
+# Validate a data file by its name in the levels directory
+def validate_file(data, name: str, action_types: tuple = ACTION_TYPES):
+    if name == "credits":
+        return validate_credits(data, name)
+    return validate_level(data, name, action_types)
+
+
+'''
+==========
+LEVEL CACHE
+=========='''
+
+# Write a file atomically: a temporary file is written, synced to disk and renamed over the target
+def write_atomic(path: str, raw: bytes):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path + ".tmp", "wb") as file:
+        file.write(raw)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(path + ".tmp", path)
+
+# Compile a validated level file into its binary cache file
+def compile_level(source: str, target: str, action_types: tuple = ACTION_TYPES):
+    name = os.path.splitext(os.path.basename(source))[0]
+    with open(source, "rb") as file:
+        raw = file.read()
+    stat = os.stat(source)
+    data = validate_file(json.loads(raw), name, action_types)
+    header = CACHE_HEADER.pack(CACHE_VERSION, marshal.version, stat.st_size, stat.st_mtime_ns)
+    write_atomic(target, CACHE_MAGIC + header + marshal.dumps(data))
+    return data
+
+# Read a cache file with one read, returns None if it is missing or stale
+def read_cache(target: str, source: str):
+    try:
+        with open(target, "rb") as file:
+            raw = file.read()
+        stat = os.stat(source)
+    except OSError:
+        return None
+    start = len(CACHE_MAGIC) + CACHE_HEADER.size
+    if raw[:len(CACHE_MAGIC)] != CACHE_MAGIC:
+        return None
+    version, marshal_version, size, mtime = CACHE_HEADER.unpack(raw[len(CACHE_MAGIC):start])
+    if (version, marshal_version, size, mtime) != (CACHE_VERSION, marshal.version, stat.st_size, stat.st_mtime_ns):
+        return None
+    try:
+        return marshal.loads(raw[start:])
+    except (EOFError, ValueError, TypeError):
+        return None
+
+# Load the data of a level file, from its cache if that is up to date
+def load_level_data(source: str, target: str = None, action_types: tuple = ACTION_TYPES):
+    if target:
+        data = read_cache(target, source)
+        if data is not None:
+            return data
+    name = os.path.splitext(os.path.basename(source))[0]
+    return validate_file(read_json(source), name, action_types)
+
+# Compile all level files in levels_dir into cache_dir
+def compile_levels(levels_dir: str = LEVELS_DIR, cache_dir: str = CACHE_DIR, action_types: tuple = ACTION_TYPES):
+    compiled = [].copy()
+    for f in sorted(os.listdir(levels_dir)):
+        if f.endswith(".json"):
+            name = f[:-len(".json")]
+            compile_level(os.path.join(levels_dir, f), os.path.join(cache_dir, name + ".lvl"), action_types)
+            compiled.append(name)
+    return compiled
+
+
+'''
+=========
+SAVESTATES
+========='''
+
+# Encode savestate data: magic, header (version, payload size, CRC-32 of the payload), zlib compressed compact JSON
+def encode_savestate(data: dict):
+    payload = zlib.compress(json.dumps(validate_savestate(data), separators=(",", ":")).encode("utf-8"), 9)
+    return SAVE_MAGIC + SAVE_HEADER.pack(SAVE_VERSION, len(payload), zlib.crc32(payload)) + payload
+
+# Decode and validate savestate data, raises DataFormatError if it is damaged or of another version
+def decode_savestate(raw: bytes, name: str = "savestate"):
+    start = len(SAVE_MAGIC) + SAVE_HEADER.size
+    if raw[:len(SAVE_MAGIC)] != SAVE_MAGIC or len(raw) < start:
+        raise DataFormatError(f"{name}: not a savestate file")
+    version, size, crc = SAVE_HEADER.unpack(raw[len(SAVE_MAGIC):start])
+    if version != SAVE_VERSION:
+        raise DataFormatError(f"{name}: savestate version {version}, expected {SAVE_VERSION}")
+    payload = raw[start:]
+    if len(payload) != size or zlib.crc32(payload) != crc:
+        raise DataFormatError(f"{name}: savestate is damaged (checksum mismatch)")
+    try:
+        data = json.loads(zlib.decompress(payload).decode("utf-8"))
+    except (zlib.error, UnicodeDecodeError, ValueError) as e:
+        raise DataFormatError(f"{name}: {e}")
+    return validate_savestate(data, name)
+
+# Parse the savestate of the first versions, the repr of its Enum: a dict literal with Item(...) and Inventory({...}) calls
+def parse_legacy_savestate(text: str, name: str = "savestate"):
+    def convert(node):
+        if isinstance(node, ast.Constant):
+            return node.value
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub) and isinstance(node.operand, ast.Constant):
+            return -node.operand.value
+        if isinstance(node, (ast.List, ast.Tuple)):
+            return [convert(i) for i in node.elts]
+        if isinstance(node, ast.Dict):
+            return {convert(k): convert(v) for k, v in zip(node.keys, node.values)}
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in ("Item", "Inventory"):
+            args = [convert(a) for a in node.args]
+            kwargs = {k.arg: convert(k.value) for k in node.keywords}
+            if node.func.id == "Item":
+                return dict({"$type": "Item"}, **dict(zip(("type", "count", "slot", "data"), args)), **kwargs)
+            return dict({"$type": "Inventory"}, **(args[0] if args else {}), **kwargs)
+        raise DataFormatError(f"{name}: line {node.lineno}: unsupported expression in an old savestate")
+    try:
+        tree = ast.parse(text, mode="eval")
+    except SyntaxError as e:
+        raise DataFormatError(f"{name}: {e}")
+    return validate_savestate(convert(tree.body), name)
+
+# Read savestate data from a file, an old plain JSON or repr savestate is read as well
+def read_savestate(path: str):
+    with open(path, "rb") as file:
+        raw = file.read()
+    if raw[:len(SAVE_MAGIC)] == SAVE_MAGIC:
+        return decode_savestate(raw, path)
+    try:
+        text = raw.decode("utf-8")
+    except UnicodeDecodeError as e:
+        raise DataFormatError(f"{path}: {e}")
+    try:
+        data = json.loads(text)
+    except ValueError:
+        return parse_legacy_savestate(text, path)
+    return validate_savestate(data, path)
+
+
+'''
+===============
+BACKGROUND TILES
+==============='''
+
+# Split a level background into tile images, returns the "background" entry for the level file
+def split_background(lvl_id: str, tile_size: int = 256, images_dir: str = IMAGES_DIR):
+    import pygame
+    source = os.path.join(images_dir, "levels", f"{lvl_id}-background.png")
+    target = os.path.join(images_dir, "levels", f"{lvl_id}-background")
+    image = pygame.image.load(source)
+    size = image.get_size()
+    os.makedirs(target, exist_ok=True)
+    for x in range(-(-size[0] // tile_size)):
+        for y in range(-(-size[1] // tile_size)):
+            rect = pygame.Rect(x * tile_size, y * tile_size, tile_size, tile_size).clip(image.get_rect())
+            pygame.image.save(image.subsurface(rect), os.path.join(target, f"{x}-{y}.png"))
+    return {"size": list(size), "tile_size": tile_size}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compile the level cache or split level backgrounds into tiles.")
+    parser.add_argument("--levels", default=LEVELS_DIR, help="directory of the level files")
+    parser.add_argument("--cache", default=CACHE_DIR, help="directory of the compiled level cache")
+    parser.add_argument("--tiles", nargs="+", metavar="LEVEL", help="split the backgrounds of these levels into tiles")
+    parser.add_argument("--tile-size", type=int, default=256)
+    parser.add_argument("--action-types", nargs="+", default=[], metavar="TYPE", help="action types registered by the game, besides the built-in ones")
+    args = parser.parse_args()
+
+    if args.tiles:
+        for lvl_id in args.tiles:
+            print(f'{lvl_id}: "background": {json.dumps(split_background(lvl_id, args.tile_size))}')
+    else:
+        try:
+            for name in compile_levels(args.levels, args.cache, ACTION_TYPES + tuple(args.action_types)):
+                print(f"compiled {name}")
+        except DataFormatError as e:
+            print(e, file=sys.stderr)
+            sys.exit(1)
@@ -0,0 +1,63 @@
+#!/bin/python3
+
+# Tests for loading damaged savestates, run headless from the game directory (with dia_graphics in it):
+#   python -m unittest discover tests
+
+import logging
+import os
+import sys
+import tempfile
+import unittest
+
+GAME_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault("RPG_HEADLESS", "1")
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+os.chdir(GAME_DIR)
+sys.path.insert(0, GAME_DIR)
+
+import rpg
+import rpg_data
+
+
+class TestDamagedSavestate(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.dir.name, "savestate.sav")
+        rpg.save_savestate(rpg.DEFAULT_SAVESTATE, self.filename)
+        rpg.SAVER.flush()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    # flip a byte of the payload, so the checksum doesn't match anymore
+    def corrupt(self):
+        with open(self.filename, "rb") as file:
+            raw = bytearray(file.read())
+        raw[-1] ^= 0xFF
+        with open(self.filename, "wb") as file:
+            file.write(raw)
+
+    def test_intact_savestate_loads(self):
+        savestate = rpg.load_savestate(filename = self.filename)
+        self.assertEqual(savestate.level_id, rpg.DEFAULT_SAVESTATE.level_id)
+
+    def test_corrupted_savestate_warns_and_falls_back_to_default(self):
+        self.corrupt()
+        default = rpg.Enum()
+        with self.assertLogs("rpg.save", "WARNING") as logs:
+            savestate = rpg.load_savestate(default = default, filename = self.filename)
+        self.assertIs(savestate, default)
+        self.assertTrue(any("checksum mismatch" in line for line in logs.output))
+
+    def test_game_logging_passes_warnings(self):
+        self.assertLessEqual(logging.getLogger("rpg.save").getEffectiveLevel(), logging.INFO)
+
+    def test_corrupted_savestate_is_rejected(self):
+        self.corrupt()
+        with self.assertRaises(rpg_data.DataFormatError):
+            rpg_data.read_savestate(self.filename)
+
+
+if __name__ == "__main__":
+    unittest.main()